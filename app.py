@@ -1,13 +1,37 @@
-from flask import Flask, request, jsonify
-from xhs import XhsClient
+from flask import Flask, request, jsonify, make_response, send_file, Response, stream_with_context
+from xhs import XhsClient, NoteType
 import requests
 import logging
 import sys
 import time
 import tempfile
 import os
+import re
+import json
+import math
+import hashlib
+import heapq
+import random
+import threading
+import uuid
+import secrets
+import sqlite3
+import cProfile
+import pstats
+import tracemalloc
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing, contextmanager, nullcontext
+from datetime import datetime
 from functools import wraps
 from pathlib import Path
+from urllib.parse import urlparse
+
+try:
+    import fcntl
+except ImportError:  # Windows：没有文件锁，按单进程运行定时发布
+    fcntl = None
 
 # 配置日志 - 针对 Vercel 优化
 def setup_logger():
@@ -79,6 +103,35 @@ def retry_on_failure(max_retries=3, delay=1):
     return decorator
 
 
+# 外部请求的超时与重试次数（草稿提交锁的有效期也按这些值计算）
+SIGN_REQUEST_TIMEOUT = 15
+SIGN_MAX_RETRIES = 3
+XHS_REQUEST_TIMEOUT = 10  # XhsClient 默认超时
+IMAGE_DOWNLOAD_TIMEOUT = 30
+PUBLISH_MAX_RETRIES = 3
+PUBLISH_RETRY_DELAY = 2
+
+
+def parse_cookie(cookie: str) -> dict:
+    """把 Cookie 字符串解析为字典"""
+    cookie_dict = {}
+    for item in (cookie or '').split(';'):
+        item = item.strip()
+        if '=' in item:
+            key, value = item.split('=', 1)
+            cookie_dict[key.strip()] = value.strip()
+    return cookie_dict
+
+
+def load_accounts(path: str) -> dict:
+    """读取账号文件（JSON：{账号 ID: Cookie}）"""
+    with open(path, 'r', encoding='utf-8') as f:
+        accounts = json.load(f)
+    if not isinstance(accounts, dict) or not all(isinstance(cookie, str) for cookie in accounts.values()):
+        raise ValueError(f'Accounts file must be a JSON object of {{account_id: cookie}}: {path}')
+    return accounts
+
+
 def validate_cookie(cookie: str) -> bool:
     """
     验证 Cookie 格式是否包含必要字段
@@ -94,13 +147,7 @@ def validate_cookie(cookie: str) -> bool:
     
     # 小红书必需的三个 Cookie 字段
     required_fields = ['a1', 'web_session', 'webId']
-    cookie_dict = {}
-    
-    for item in cookie.split(';'):
-        item = item.strip()
-        if '=' in item:
-            key, value = item.split('=', 1)
-            cookie_dict[key.strip()] = value.strip()
+    cookie_dict = parse_cookie(cookie)
     
     # 检查是否所有必需字段都存在且非空
     missing_fields = [field for field in required_fields if field not in cookie_dict or not cookie_dict[field]]
@@ -117,536 +164,2441 @@ def validate_cookie(cookie: str) -> bool:
     return True
 
 
-# ========== 全局错误处理器 ==========
+# ========== 共享状态 ==========
 
-@app.errorhandler(Exception)
-def handle_exception(e):
-    """捕获所有未处理的异常"""
-    logger.error("=" * 50)
-    logger.error(f"未捕获的异常: {type(e).__name__}")
-    logger.error(f"错误信息: {str(e)}", exc_info=True)
-    logger.error("=" * 50)
-    sys.stdout.flush()  # 强制刷新日志
+class StateBackend(ABC):
+    """
+    共享状态后端接口：带 TTL 的 JSON 键值存储 + 计数器
     
-    return jsonify({
-        'success': False,
-        'error': f'Internal server error: {str(e)}',
-        'error_type': type(e).__name__
-    }), 500
+    缓存（web_a1、签名、上传 file_id）、幂等记录和限流计数都通过它读写，
+    多个 worker / 实例配置同一个后端即可共享。
+    """
 
+    name = 'base'
 
-@app.errorhandler(404)
-def handle_404(e):
-    """处理 404 错误"""
-    logger.warning(f"404 错误 - 路径: {request.path}")
-    sys.stdout.flush()
-    
-    return jsonify({
-        'success': False,
-        'error': 'Endpoint not found',
-        'path': request.path
-    }), 404
+    # 只有缓存类的键参与 LRU 淘汰；草稿、幂等记录、限流计数等只按 TTL 过期，
+    # 不会被大量签名缓存挤掉
+    EVICTABLE_PREFIXES = ('web_a1:', 'sign:', 'upload:', 'topic:')
 
+    @classmethod
+    def is_evictable(cls, key: str) -> bool:
+        return key.startswith(cls.EVICTABLE_PREFIXES)
 
-@app.errorhandler(400)
-def handle_400(e):
-    """处理 400 错误"""
-    logger.warning(f"400 错误: {str(e)}")
-    sys.stdout.flush()
+    @abstractmethod
+    def get(self, key: str):
+        """读取值，不存在或已过期返回 None"""
+
+    @abstractmethod
+    def set(self, key: str, value, ttl: float = None):
+        pass
+
+    @abstractmethod
+    def set_if_absent(self, key: str, value, ttl: float = None) -> bool:
+        """键不存在（或已过期）时写入并返回 True，否则返回 False"""
+
+    @abstractmethod
+    def delete(self, key: str):
+        pass
+
+    @abstractmethod
+    def incr(self, key: str, ttl: float = None) -> int:
+        """计数器加一并返回新值；ttl 只在计数器新建时设置（固定窗口）"""
+
+    def purge_expired(self) -> int:
+        """清理已过期的条目，返回清理数量（后端自带过期机制时无需实现）"""
+        return 0
+
+
+class MemoryStateBackend(StateBackend):
+    """进程内后端（单 worker 部署或测试使用），缓存条目超过 max_entries 时按 LRU 淘汰"""
+
+    name = 'memory'
+
+    def __init__(self, max_entries: int = 50000):
+        self.max_entries = max_entries
+        self._caches = OrderedDict()  # 可淘汰的缓存：key -> (value, expires_at)
+        self._data = {}  # 其余条目，只按 TTL 过期
+        self._lock = threading.Lock()
+
+    def _store(self, key: str):
+        return self._caches if self.is_evictable(key) else self._data
+
+    def _get_entry(self, key: str):
+        store = self._store(key)
+        entry = store.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.time():
+            del store[key]
+            return None
+        if store is self._caches:
+            self._caches.move_to_end(key)
+        return entry
+
+    def _put(self, key: str, value, ttl: float = None):
+        store = self._store(key)
+        store[key] = (value, time.time() + ttl if ttl else None)
+        if store is self._caches:
+            self._caches.move_to_end(key)
+            while len(self._caches) > self.max_entries:
+                self._caches.popitem(last=False)
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._get_entry(key)
+            return entry[0] if entry else None
+
+    def set(self, key: str, value, ttl: float = None):
+        with self._lock:
+            self._put(key, value, ttl)
+
+    def set_if_absent(self, key: str, value, ttl: float = None) -> bool:
+        with self._lock:
+            if self._get_entry(key):
+                return False
+            self._put(key, value, ttl)
+            return True
+
+    def delete(self, key: str):
+        with self._lock:
+            self._store(key).pop(key, None)
+
+    def incr(self, key: str, ttl: float = None) -> int:
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry:
+                value = entry[0] + 1
+                self._store(key)[key] = (value, entry[1])
+            else:
+                value = 1
+                self._put(key, value, ttl)
+            return value
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        purged = 0
+        with self._lock:
+            for store in (self._caches, self._data):
+                expired = [key for key, (_, expires_at) in store.items() if expires_at is not None and expires_at <= now]
+                for key in expired:
+                    del store[key]
+                purged += len(expired)
+        return purged
+
+
+class SqliteStateBackend(StateBackend):
+    """
+    SQLite 后端：同一台机器上的多个 worker 共享（路径放在 /dev/shm 下即为共享内存）
     
-    return jsonify({
-        'success': False,
-        'error': 'Bad request',
-        'message': str(e)
-    }), 400
+    缓存条目单独存放在 cache 表，新增条目后超过 max_entries 立即按最近使用时间淘汰；
+    其余条目存放在 state 表，只按 TTL 过期。过期条目在写入时顺带清理。
+    """
 
+    name = 'sqlite'
 
-@app.before_request
-def log_request():
-    """记录每个请求"""
-    logger.info(f"收到请求 [{request.method}] {request.path}")
-    logger.info(f"来源 IP: {request.remote_addr}")
-    logger.info(f"User-Agent: {request.headers.get('User-Agent', 'Unknown')}")
-    sys.stdout.flush()
+    def __init__(self, db_path: str, max_entries: int = 50000):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self._writes = 0
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            for table in ('state', 'cache'):
+                conn.execute(
+                    f'CREATE TABLE IF NOT EXISTS {table} ('
+                    ' key TEXT PRIMARY KEY, value TEXT NOT NULL,'
+                    ' expires_at REAL, last_used_at REAL NOT NULL)'
+                )
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used_at)')
 
+    def _connect(self):
+        # isolation_level=None：手动用 BEGIN IMMEDIATE 保证跨进程的读-改-写原子性
+        return closing(sqlite3.connect(self.db_path, timeout=10, isolation_level=None))
 
-@app.after_request
-def log_response(response):
-    """记录每个响应"""
-    logger.info(f"响应状态码: {response.status_code}")
-    sys.stdout.flush()
-    return response
+    def _table(self, key: str) -> str:
+        return 'cache' if self.is_evictable(key) else 'state'
 
+    def _read(self, conn, key: str, now: float):
+        row = conn.execute(f'SELECT value, expires_at FROM {self._table(key)} WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= now):
+            return None
+        return row
 
-@app.get('/')
-def index():
-    """API 根路径"""
-    logger.info("访问根路径")
-    sys.stdout.flush()
-    return jsonify({
-        'message': 'XiaoHongShu Publish API',
-        'version': '1.0.0',
-        'status': 'running',
-        'endpoints': {
-            'health': '/api/health',
-            'publish': '/api/publish'
-        }
-    })
+    def _write(self, conn, key: str, value, ttl: float, now: float):
+        table = self._table(key)
+        conn.execute(
+            f'INSERT OR REPLACE INTO {table} VALUES (?, ?, ?, ?)',
+            (key, json.dumps(value, ensure_ascii=False), now + ttl if ttl else None, now)
+        )
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self._delete_expired(conn, now)
+        if table == 'cache':
+            self._evict(conn, now)
 
+    def _evict(self, conn, now: float):
+        """缓存条目超过 max_entries 时，先清理过期条目，仍超出则删除最久未使用的"""
+        excess = conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0] - self.max_entries
+        if excess <= 0:
+            return
+        excess -= conn.execute('DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?', (now,)).rowcount
+        if excess > 0:
+            conn.execute(
+                'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_used_at LIMIT ?)',
+                (excess,)
+            )
 
-@app.get('/api/health')
-def health():
-    """健康检查接口"""
-    return jsonify({
-        'status': 'healthy',
-        'service': 'xiaohongshu-publish-api',
-        'version': '1.0.0'
-    })
+    @staticmethod
+    def _delete_expired(conn, now: float) -> int:
+        return sum(
+            conn.execute(f'DELETE FROM {table} WHERE expires_at IS NOT NULL AND expires_at <= ?', (now,)).rowcount
+            for table in ('state', 'cache')
+        )
 
+    def get(self, key: str):
+        now = time.time()
+        with self._connect() as conn:
+            row = self._read(conn, key, now)
+            if row is None:
+                return None
+            if self._table(key) == 'cache':
+                conn.execute('UPDATE cache SET last_used_at = ? WHERE key = ?', (now, key))
+            return json.loads(row[0])
 
-@app.post('/api/publish')
-def publish():
-    """小红书笔记发布接口"""
-    logger.info("开始处理发布请求")
-    sys.stdout.flush()
+    def set(self, key: str, value, ttl: float = None):
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            self._write(conn, key, value, ttl, time.time())
+            conn.execute('COMMIT')
+
+    def set_if_absent(self, key: str, value, ttl: float = None) -> bool:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if self._read(conn, key, now) is not None:
+                conn.execute('ROLLBACK')
+                return False
+            self._write(conn, key, value, ttl, now)
+            conn.execute('COMMIT')
+            return True
+
+    def delete(self, key: str):
+        with self._connect() as conn:
+            conn.execute(f'DELETE FROM {self._table(key)} WHERE key = ?', (key,))
+
+    def incr(self, key: str, ttl: float = None) -> int:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = self._read(conn, key, now)
+            if row is None:
+                value = 1
+                self._write(conn, key, value, ttl, now)
+            else:
+                value = json.loads(row[0]) + 1
+                conn.execute(
+                    f'UPDATE {self._table(key)} SET value = ?, last_used_at = ? WHERE key = ?',
+                    (json.dumps(value), now, key)
+                )
+            conn.execute('COMMIT')
+            return value
+
+    def purge_expired(self) -> int:
+        with self._connect() as conn:
+            return self._delete_expired(conn, time.time())
+
+
+class RedisStateBackend(StateBackend):
+    """
+    Redis 后端：跨机器 / 跨 Serverless 实例共享
     
-    temp_files = []
+    client 可以是 redis.Redis 或任何兼容的实现（如本地的 fakeredis）。
+    Redis 无法按键前缀区分淘汰，所有条目都带 TTL；应配置 maxmemory-policy noeviction
+    （或为缓存单独使用一个实例），避免内存紧张时淘汰草稿和幂等记录。
+    """
+
+    name = 'redis'
+
+    def __init__(self, client, prefix: str = 'xhs:'):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('XHS_STATE_BACKEND=redis requires the redis package: pip install redis')
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key: str):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value, ttl: float = None):
+        self.client.set(self.prefix + key, json.dumps(value, ensure_ascii=False), px=int(ttl * 1000) if ttl else None)
+
+    def set_if_absent(self, key: str, value, ttl: float = None) -> bool:
+        return bool(self.client.set(
+            self.prefix + key, json.dumps(value, ensure_ascii=False),
+            px=int(ttl * 1000) if ttl else None, nx=True
+        ))
+
+    def delete(self, key: str):
+        self.client.delete(self.prefix + key)
+
+    def incr(self, key: str, ttl: float = None) -> int:
+        value = self.client.incr(self.prefix + key)
+        if value == 1 and ttl:
+            self.client.pexpire(self.prefix + key, int(ttl * 1000))
+        return value
+
+
+def create_state_backend() -> StateBackend:
+    """
+    根据环境变量创建状态后端
     
-    try:
-        # 1. 获取并验证 Cookie
-        cookie = request.headers.get('X-XHS-Cookie')
-        if not cookie:
-            logger.error("请求缺少 X-XHS-Cookie header")
-            sys.stdout.flush()
-            return jsonify({
-                'success': False,
-                'error': 'X-XHS-Cookie header is required'
-            }), 400
-        
-        logger.info(f"收到发布请求，Cookie: {mask_cookie(cookie)}")
-        sys.stdout.flush()
-        
-        if not validate_cookie(cookie):
-            logger.error("Cookie 格式无效或缺少必要字段")
-            sys.stdout.flush()
-            return jsonify({
-                'success': False,
-                'error': 'Invalid cookie: missing required fields',
-                'message': 'Cookie must contain: a1, web_session, and webId',
-                'hint': 'Please get complete cookie from xiaohongshu.com while logged in'
-            }), 401
-        
-        # 2. 解析并验证请求体
-        data = request.get_json()
-        if not data:
-            logger.error("请求体为空")
-            sys.stdout.flush()
-            return jsonify({
-                'success': False,
-                'error': 'Request body is required'
-            }), 400
-        
-        title = data.get('title')
-        content = data.get('content')
-        image_url = data.get('image_url')
-        image_urls = data.get('image_urls', [])
-        is_private = data.get('is_private', False)
-        
-        if not title:
-            logger.error("缺少 title 字段")
-            sys.stdout.flush()
-            return jsonify({
-                'success': False,
-                'error': 'title is required'
-            }), 400
-            
-        if not content:
-            logger.error("缺少 content 字段")
+    XHS_STATE_BACKEND: sqlite（默认）| memory | redis
+    """
+    backend = os.environ.get('XHS_STATE_BACKEND', 'sqlite').lower()
+    max_entries = int(os.environ.get('XHS_STATE_MAX_ENTRIES', '50000'))
+
+    if backend == 'memory':
+        return MemoryStateBackend(max_entries=max_entries)
+    if backend == 'sqlite':
+        return SqliteStateBackend(
+            os.environ.get('XHS_STATE_PATH') or os.path.join(tempfile.gettempdir(), 'xhs_state.db'),
+            max_entries=max_entries,
+        )
+    if backend == 'redis':
+        return RedisStateBackend.from_url(os.environ.get('XHS_STATE_REDIS_URL', 'redis://localhost:6379/0'))
+    raise ValueError(f'Unknown XHS_STATE_BACKEND: {backend} (expected sqlite, memory or redis)')
+
+
+_state_backend = None
+_state_backend_lock = threading.Lock()
+
+
+def get_state_backend() -> StateBackend:
+    """获取全局状态后端（首次调用时创建）"""
+    global _state_backend
+    with _state_backend_lock:
+        if _state_backend is None:
+            _state_backend = create_state_backend()
+            logger.info(f"🗄️ 共享状态后端: {_state_backend.name}")
             sys.stdout.flush()
-            return jsonify({
-                'success': False,
-                'error': 'content is required'
-            }), 400
-        
-        logger.info(f"笔记信息 - 标题: {title[:20]}, 内容长度: {len(content)}, 私密: {is_private}")
-        sys.stdout.flush()
-        
-        # 3. 初始化小红书客户端
+        return _state_backend
+
+
+def set_state_backend(backend: StateBackend):
+    """替换全局状态后端（如注入自定义的 Redis 兼容客户端）"""
+    global _state_backend
+    with _state_backend_lock:
+        _state_backend = backend
+
+
+# ========== 请求合并 ==========
+
+class SingleFlight:
+    """
+    合并并发的相同请求（single-flight）
+    
+    同一个 key 同时只有一个调用真正执行，其余并发调用等待它完成并共享结果（或异常），
+    避免大量请求同时到达时重复打到签名服务器和图床。
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {'calls': 0, 'executed': 0, 'coalesced': 0}
+
+    def do(self, key, fn):
+        with self._lock:
+            self._stats['calls'] += 1
+            call = self._calls.get(key)
+            if call is not None:
+                self._stats['coalesced'] += 1
+                leader = False
+            else:
+                call = self._calls[key] = self._Call()
+                self._stats['executed'] += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
         try:
-            logger.info("正在初始化小红书客户端...")
-            sys.stdout.flush()
-            
-            # 获取签名服务器 URL（必须配置）
-            sign_server_url = os.environ.get('XHS_SIGN_SERVER_URL', '')
-            
-            if not sign_server_url:
-                logger.error("❌ 未配置 XHS_SIGN_SERVER_URL 环境变量")
-                logger.error("请先启动签名服务器并设置环境变量")
-                logger.error("")
-                logger.error("启动步骤：")
-                logger.error("  1. 启动签名服务器: python sign_server.py")
-                logger.error("  2. 设置环境变量: set XHS_SIGN_SERVER_URL=http://localhost:5005")
-                logger.error("  3. 启动发布服务器: python app.py")
-                logger.error("")
-                logger.error("或者使用快捷脚本: start_all.bat (Windows) 或 ./start_all.sh (Linux/Mac)")
-                logger.error("")
-                logger.error("详细文档: README_SIGN_SERVER.md")
-                sys.stdout.flush()
-                return jsonify({
-                    'success': False,
-                    'error': 'XHS_SIGN_SERVER_URL environment variable is required',
-                    'message': 'Please start sign_server.py first and set XHS_SIGN_SERVER_URL environment variable',
-                    'hint': 'Run: python sign_server.py, then set XHS_SIGN_SERVER_URL=http://localhost:5005'
-                }), 500
-            
-            logger.info(f"✅ 使用外部签名服务: {sign_server_url}")
-            sys.stdout.flush()
-            
-            # 从 Cookie 中提取必需的三个字段
-            cookie_dict = {}
-            for item in cookie.split(';'):
-                item = item.strip()
-                if '=' in item:
-                    key, value = item.split('=', 1)
-                    cookie_dict[key.strip()] = value.strip()
-            
-            cookie_a1 = cookie_dict.get('a1', '')
-            cookie_web_session = cookie_dict.get('web_session', '')
-            cookie_web_id = cookie_dict.get('webId', '')
-            
-            logger.info(f"📝 从 Cookie 提取认证信息:")
-            logger.info(f"   a1: {cookie_a1[:20]}...")
-            logger.info(f"   web_session: {cookie_web_session[:20]}...")
-            logger.info(f"   webId: {cookie_web_id[:20]}...")
-            sys.stdout.flush()
-            
-            # 签名缓存（避免相同请求重复签名）
-            sign_cache = {}
-            sign_request_count = [0]  # 使用列表以便在闭包中修改
-            
-            # 使用外部签名服务
-            def external_sign(uri, data=None, a1="", web_session=""):
-                """
-                调用外部签名服务（带重试机制和智能缓存）
-                
-                注意：发布笔记需要多次签名是正常的！
-                - 获取上传凭证（/api/media/v1/upload/web/permit）
-                - 上传图片（可能需要签名）
-                - 发布笔记（/web_api/sns/v2/note）
-                每个请求的 URI 和 data 不同，签名也必须不同，不能重用！
-                
-                优化策略：
-                - 对于相同的 uri + data，使用缓存（避免重复请求）
-                - 失败后才重试，成功的签名直接使用
-                """
-                # 如果 XhsClient 没有传递，使用从 Cookie 中提取的值
-                actual_a1 = a1 if a1 else cookie_a1
-                actual_web_session = web_session if web_session else cookie_web_session
-                actual_web_id = cookie_web_id
-                
-                # 生成缓存键（基于 uri 和 data）
-                import json
-                import hashlib
-                cache_key = hashlib.md5(
-                    f"{uri}:{json.dumps(data, sort_keys=True)}".encode()
-                ).hexdigest()
-                
-                # 检查缓存
-                if cache_key in sign_cache:
-                    logger.info(f"♻️ 使用缓存的签名 - URI: {uri}")
-                    sys.stdout.flush()
-                    return sign_cache[cache_key]
-                
-                # 增加请求计数
-                sign_request_count[0] += 1
-                request_num = sign_request_count[0]
-                
-                max_retries = 3
-                last_error = None
-                
-                for attempt in range(max_retries):
-                    try:
-                        logger.info(f"📝 [签名请求 #{request_num}] [尝试 {attempt + 1}/{max_retries}] URI: {uri}")
-                        sys.stdout.flush()
-                        
-                        response = requests.post(
-                            f"{sign_server_url}/sign",
-                            json={
-                                "uri": uri,
-                                "data": data,
-                                "a1": actual_a1,
-                                "web_session": actual_web_session,
-                                "web_id": actual_web_id
-                            },
-                            timeout=15
-                        )
-                        response.raise_for_status()
-                        signs = response.json()
-                        
-                        # 检查返回格式
-                        if 'x-s' not in signs or 'x-t' not in signs:
-                            raise ValueError(f"签名服务返回格式错误: {signs}")
-                        
-                        # 缓存成功的签名
-                        sign_cache[cache_key] = signs
-                        
-                        logger.info(f"✅ [签名请求 #{request_num}] 签名获取成功")
-                        sys.stdout.flush()
-                        return signs
-                        
-                    except Exception as e:
-                        last_error = e
-                        logger.warning(f"❌ [签名请求 #{request_num}] [尝试 {attempt + 1}/{max_retries}] 失败: {str(e)}")
-                        sys.stdout.flush()
-                        
-                        if attempt < max_retries - 1:
-                            wait_time = 1 * (attempt + 1)
-                            logger.info(f"⏳ 等待 {wait_time} 秒后重试...")
-                            sys.stdout.flush()
-                            time.sleep(wait_time)
-                
-                # 所有重试都失败
-                logger.error(f"💥 [签名请求 #{request_num}] 重试 {max_retries} 次后仍然失败")
-                sys.stdout.flush()
-                raise last_error
-            
-            # 进行一次请求，获取签名端 a1，并设置到 cookie 中
-            logger.info(f"📡 正在从签名服务器获取 a1...")
-            sys.stdout.flush()
-            
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, 'in_flight': len(self._calls)}
+
+
+# 各类出站请求的合并组：签名端 a1、图片下载（按 URL）、签名（按 uri + data + 身份）
+SINGLE_FLIGHT = {
+    'web_a1': SingleFlight('web_a1'),
+    'image': SingleFlight('image'),
+    'sign': SingleFlight('sign'),
+}
+
+
+# ========== 准入控制 ==========
+
+class AdmissionController:
+    """
+    发布请求的准入控制（按进程）
+    
+    - 同时处理的发布数不超过 limit，超出的请求进入有界等待队列，等待超过 queue_timeout 秒即放弃
+    - 队列已满或等待超时的请求立即被拒绝（429 + Retry-After），避免签名服务器变慢时所有 worker 被占满
+    - limit 根据签名和小红书接口的延迟自适应调整（AIMD）：延迟超过目标时乘性减小，否则缓慢加性增大
+    """
+
+    def __init__(self, max_limit: int, min_limit: int, queue_size: int, queue_timeout: float, latency_targets: dict):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.latency_targets = latency_targets
+        self.limit = float(max_limit)
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        self._admitted = 0
+        self._shed = 0
+        self._latency_ewma = {}
+
+    def acquire(self) -> bool:
+        """申请一个发布名额，返回 False 表示应拒绝请求"""
+        with self._cond:
+            if self._in_flight < int(self.limit):
+                self._in_flight += 1
+                self._admitted += 1
+                return True
+            if self._waiting >= self.queue_size:
+                self._shed += 1
+                return False
+
+            self._waiting += 1
+            deadline = time.time() + self.queue_timeout
             try:
-                response = requests.get(f"{sign_server_url}/web_a1", timeout=10)
-                response.raise_for_status()
-                web_a1 = response.json().get('web_a1')
-                
-                if not web_a1:
-                    logger.error(f"❌ 签名服务器返回的 web_a1 为空")
-                    logger.error(f"   响应: {response.text[:200]}")
-                    sys.stdout.flush()
-                    return jsonify({
-                        'success': False,
-                        'error': 'Failed to get web_a1 from sign server',
-                        'message': 'Sign server returned empty web_a1'
-                    }), 500
-                
-                logger.info(f"✅ 签名端 a1: {web_a1[:30]}...")
-                sys.stdout.flush()
-            except Exception as e:
-                logger.error(f"❌ 获取签名端 a1 失败: {e}")
-                sys.stdout.flush()
-                return jsonify({
-                    'success': False,
-                    'error': 'Failed to get web_a1 from sign server',
-                    'message': str(e)
-                }), 500
-            
-            # 修复：必须把 replace 的返回值赋值回 cookie！
-            if cookie_a1 and web_a1:
-                logger.info(f"🔄 正在替换 cookie 中的 a1 字段")
-                logger.info(f"   原 a1: {cookie_a1[:30]}...")
-                logger.info(f"   新 a1: {web_a1[:30]}...")
-                cookie = cookie.replace(cookie_a1, web_a1)
-                logger.info(f"✅ cookie 中的 a1 已更新")
+                while self._in_flight >= int(self.limit):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._shed += 1
+                        return False
+                    self._cond.wait(remaining)
+                self._in_flight += 1
+                self._admitted += 1
+                return True
+            finally:
+                self._waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify()
+
+    def observe_latency(self, source: str, seconds: float):
+        """记录一次下游调用的延迟（source: sign / xhs），并据此调整 limit"""
+        target = self.latency_targets.get(source)
+        if not target:
+            return
+        with self._cond:
+            previous = self._latency_ewma.get(source)
+            ewma = seconds if previous is None else 0.2 * seconds + 0.8 * previous
+            self._latency_ewma[source] = ewma
+
+            if ewma > target:
+                self.limit = max(float(self.min_limit), self.limit * 0.9)
             else:
-                logger.warning(f"⚠️ 无法替换 a1: cookie_a1={bool(cookie_a1)}, web_a1={bool(web_a1)}")
-            
-            logger.info(f"✅ 更新后 cookie: {cookie[:80]}...")
-            sys.stdout.flush()
+                old_limit = int(self.limit)
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+                if int(self.limit) > old_limit:
+                    self._cond.notify(int(self.limit) - old_limit)
 
-            # 创建客户端（必须提供 sign 参数）
-            client = XhsClient(cookie=cookie, sign=external_sign)
-            
-            logger.info("✅ 小红书客户端初始化成功")
-            logger.info(f"Client 类型: {type(client)}")
-            logger.info(f"External sign 函数: {client.external_sign}")
-            sys.stdout.flush()
-            
-            # 验证 create_image_note 方法是否存在和可调用
-            if not hasattr(client, 'create_image_note'):
-                logger.error("❌ XhsClient 没有 create_image_note 方法")
-                logger.error("可能是 xhs 库版本不兼容,请检查 requirements.txt")
-                sys.stdout.flush()
-                return jsonify({
-                    'success': False,
-                    'error': 'XhsClient does not have create_image_note method',
-                    'message': 'Please check xhs library version'
-                }), 500
-            
-            create_method = getattr(client, 'create_image_note', None)
-            if create_method is None or not callable(create_method):
-                logger.error(f"❌ create_image_note 不可调用: {create_method}")
-                sys.stdout.flush()
-                return jsonify({
-                    'success': False,
-                    'error': 'create_image_note method is not callable'
-                }), 500
-                
-            logger.info("✅ create_image_note 方法验证通过")
-            sys.stdout.flush()
-            
-        except Exception as e:
-            logger.error(f"❌ 小红书客户端初始化失败: {str(e)}", exc_info=True)
-            sys.stdout.flush()
-            return jsonify({
-                'success': False,
-                'error': f'Failed to initialize XHS client: {str(e)}',
-                'error_type': type(e).__name__,
-                'hint': 'Please check XHS_SIGN_SERVER_URL environment variable'
-            }), 500
-        
-        # 4. 处理图片
-        image_files = []
-        urls_to_download = []
-        
-        if image_url:
-            urls_to_download = [image_url]
-        elif image_urls:
-            urls_to_download = image_urls[:9]
-        
-        if urls_to_download:
-            logger.info(f"开始下载 {len(urls_to_download)} 张图片")
-            sys.stdout.flush()
-            
-            for idx, url in enumerate(urls_to_download):
-                try:
-                    logger.info(f"下载图片 {idx + 1}/{len(urls_to_download)}: {url}")
-                    sys.stdout.flush()
-                    response = requests.get(url, timeout=30)
-                    response.raise_for_status()
-                    
-                    ext = Path(url).suffix or '.jpg'
-                    if ext.lower() not in ['.jpg', '.jpeg', '.png', '.gif', '.webp']:
-                        ext = '.jpg'
-                    
-                    temp_file = tempfile.NamedTemporaryFile(
-                        mode='wb', 
-                        suffix=ext, 
-                        delete=False
-                    )
-                    temp_file.write(response.content)
-                    temp_file.close()
-                    
-                    temp_files.append(temp_file.name)
-                    image_files.append(temp_file.name)
-                    
-                    logger.info(f"图片 {idx + 1} 下载成功，大小: {len(response.content)} bytes")
-                    sys.stdout.flush()
-                except Exception as e:
-                    logger.warning(f"图片 {idx + 1} 处理失败: {str(e)}")
-                    sys.stdout.flush()
-            
-            logger.info(f"成功下载 {len(image_files)}/{len(urls_to_download)} 张图片")
+    def retry_after(self) -> int:
+        """建议客户端的重试间隔（秒）：按当前延迟估算排队清空所需的时间"""
+        with self._cond:
+            latency = sum(self._latency_ewma.values()) or 1.0
+            estimate = latency * (self._waiting + self._in_flight + 1) / max(int(self.limit), 1)
+        return max(1, min(60, math.ceil(estimate)))
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'limit': int(self.limit),
+                'max_limit': self.max_limit,
+                'in_flight': self._in_flight,
+                'queue_depth': self._waiting,
+                'queue_size': self.queue_size,
+                'admitted': self._admitted,
+                'shed': self._shed,
+                'latency_ewma': {source: round(value, 3) for source, value in self._latency_ewma.items()},
+            }
+
+
+admission_controller = AdmissionController(
+    max_limit=int(os.environ.get('XHS_MAX_INFLIGHT_PUBLISHES', '8')),
+    min_limit=int(os.environ.get('XHS_MIN_INFLIGHT_PUBLISHES', '1')),
+    queue_size=int(os.environ.get('XHS_PUBLISH_QUEUE_SIZE', '16')),
+    queue_timeout=float(os.environ.get('XHS_PUBLISH_QUEUE_TIMEOUT', '10')),
+    latency_targets={
+        'sign': float(os.environ.get('XHS_SIGN_LATENCY_TARGET', '2')),
+        'xhs': float(os.environ.get('XHS_API_LATENCY_TARGET', '5')),
+    },
+)
+
+
+@contextmanager
+def admission_slot():
+    """
+    占用一个发布名额，饱和时抛出 PublishError(429) + Retry-After
+    
+    接口应先完成本地校验再占用名额，不合法的请求不排队、也不会被 429 掩盖真正的错误。
+    """
+    if not admission_controller.acquire():
+        retry_after = admission_controller.retry_after()
+        logger.warning(f"⚠️ 发布请求过多，已拒绝（{admission_controller.stats()}）")
+        sys.stdout.flush()
+        raise PublishError(429, {'error': 'Server is busy, please retry later', 'retry_after': retry_after},
+                           {'Retry-After': str(retry_after)})
+    try:
+        yield
+    finally:
+        admission_controller.release()
+
+
+# ========== 图片上传缓存 ==========
+
+def get_account_key(cookie: str) -> str:
+    """根据 web_session 生成账号标识（用于按账号隔离缓存，不暴露原始 Cookie）"""
+    web_session = parse_cookie(cookie).get('web_session', '')
+    return hashlib.sha256(web_session.encode()).hexdigest()[:16]
+
+
+class UploadCache:
+    """
+    图片内容哈希 → 小红书 file_id 的索引（存放在共享状态后端）
+    
+    - 按账号隔离：同一张图片在不同账号下需要分别上传
+    - TTL 过期，条目数上限和 LRU 淘汰由状态后端负责
+    - 统计本进程的命中率和节省的上传字节数
+    """
+
+    def __init__(self, backend: StateBackend, ttl_seconds: float):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0, 'bytes_uploaded': 0}
+
+    @staticmethod
+    def _key(account: str, sha256: str) -> str:
+        return f'upload:{account}:{sha256}'
+
+    def get(self, account: str, sha256: str, size: int):
+        """查询缓存的 file_id，过期条目视为未命中"""
+        entry = self.backend.get(self._key(account, sha256))
+        with self._lock:
+            if entry:
+                self._stats['hits'] += 1
+                self._stats['bytes_saved'] += size
+                return entry['file_id']
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, account: str, sha256: str, file_id: str, size: int):
+        self.backend.set(self._key(account, sha256), {'file_id': file_id, 'size': size}, ttl=self.ttl_seconds)
+        with self._lock:
+            self._stats['bytes_uploaded'] += size
+
+    def invalidate(self, account: str, sha256_list: list):
+        for sha256 in sha256_list:
+            self.backend.delete(self._key(account, sha256))
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+_upload_cache = None
+_upload_cache_lock = threading.Lock()
+
+
+def get_upload_cache():
+    """获取全局上传缓存，XHS_UPLOAD_CACHE_TTL=0 时禁用（返回 None）"""
+    global _upload_cache
+    ttl_seconds = float(os.environ.get('XHS_UPLOAD_CACHE_TTL', str(3 * 24 * 3600)))
+    if ttl_seconds <= 0:
+        return None
+    with _upload_cache_lock:
+        if _upload_cache is None:
+            _upload_cache = UploadCache(get_state_backend(), ttl_seconds=ttl_seconds)
+        return _upload_cache
+
+
+def hash_file(path: str) -> tuple:
+    """计算文件的 SHA-256，返回 (hexdigest, size)"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+@retry_on_failure(max_retries=PUBLISH_MAX_RETRIES, delay=PUBLISH_RETRY_DELAY)
+def upload_images(client: XhsClient, image_files: list, account_key: str) -> tuple:
+    """
+    上传图片并返回 (images, upload_stats)
+    
+    images 为 create_note 需要的 image_info.images 列表；内容相同的图片命中缓存时
+    直接复用已有 file_id，跳过获取上传凭证（签名）和上传。
+    重试时已上传成功的图片会命中缓存，不会重复上传。
+    """
+    cache = get_upload_cache()
+    images = []
+    upload_stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0, 'hashes': [], 'cached_hashes': []}
+
+    for idx, path in enumerate(image_files):
+        sha256, size = hash_file(path)
+        upload_stats['hashes'].append(sha256)
+        file_id = cache.get(account_key, sha256, size) if cache else None
+
+        if file_id:
+            logger.info(f"♻️ 图片 {idx + 1} 命中上传缓存，复用 file_id: {file_id}")
+            upload_stats['hits'] += 1
+            upload_stats['bytes_saved'] += size
+            upload_stats['cached_hashes'].append(sha256)
+        else:
+            logger.info(f"⬆️ 上传图片 {idx + 1}/{len(image_files)}（{size} bytes）")
+            sys.stdout.flush()
+            started = time.time()
+            file_id, token = client.get_upload_files_permit("image")
+            client.upload_file(file_id, token, path)
+            admission_controller.observe_latency('xhs', time.time() - started)
+            upload_stats['misses'] += 1
+            if cache:
+                cache.put(account_key, sha256, file_id, size)
+
+        images.append({
+            "file_id": file_id,
+            "metadata": {"source": -1},
+            "stickers": {"version": 2, "floating": []},
+            "extra_info_json": '{"mimeType":"image/jpeg"}',
+        })
+
+    logger.info(f"✅ 图片上传完成：缓存命中 {upload_stats['hits']}，新上传 {upload_stats['misses']}，节省 {upload_stats['bytes_saved']} bytes")
+    sys.stdout.flush()
+    return images, upload_stats
+
+
+# ========== 话题标签 ==========
+
+# 正文中的话题：#旅行、#旅行#、#旅行[话题]#，遇到空白、# 或常见标点结束（URL 中的 # 不算）；
+# 超过 30 个字符的标签整体保留原样，不截断成半个词
+HASHTAG_PATTERN = re.compile(r'(?<![A-Za-z0-9/&])#([^\s#\[\]，。！？、；：,.!?;:]{1,30})(?=[\s#\[\]，。！？、；：,.!?;:]|$)(?:\[话题\])?#?')
+MAX_TOPICS_PER_NOTE = 10
+
+
+def extract_hashtags(content: str) -> list:
+    """按出现顺序提取正文中的候选话题名（去重）"""
+    names = []
+    for match in HASHTAG_PATTERN.finditer(content):
+        name = match.group(1)
+        if name not in names:
+            names.append(name)
+    return names[:MAX_TOPICS_PER_NOTE]
+
+
+def resolve_topic(client: XhsClient, name: str):
+    """
+    把话题名解析为小红书话题，未找到返回 None
+    
+    结果（包括未找到）缓存在共享状态后端中，热门话题无需再请求签名服务器。
+    """
+    backend = get_state_backend()
+    cache_key = f'topic:{name}'
+    cached = backend.get(cache_key)
+    if cached is not None:
+        return cached.get('topic')
+
+    # 只接受名称完全一致的话题，避免挂上相近但不相关的话题
+    suggestions = client.get_suggest_topic(name) or []
+    match = next((item for item in suggestions if item.get('name', '').lower() == name.lower()), None)
+
+    topic = None
+    if match:
+        topic = {
+            'id': match['id'],
+            'name': match['name'],
+            'type': 'topic',
+            'link': match.get('link', ''),
+        }
+        ttl = float(os.environ.get('XHS_TOPIC_CACHE_TTL', str(7 * 24 * 3600)))
+    else:
+        # 未找到的话题也缓存，但时间更短，避免新话题长期无法识别
+        ttl = float(os.environ.get('XHS_TOPIC_MISS_TTL', '3600'))
+    backend.set(cache_key, {'topic': topic}, ttl=ttl)
+    return topic
+
+
+def attach_topics(client: XhsClient, content: str) -> tuple:
+    """
+    解析正文中的话题并返回 (topics, 改写后的正文)
+    
+    解析成功的话题在正文中改写为小红书的 #名称[话题]# 格式；单个话题解析失败只记录警告。
+    """
+    topics = []
+    for name in extract_hashtags(content):
+        try:
+            topic = resolve_topic(client, name)
+        except Exception as e:
+            logger.warning(f"⚠️ 话题解析失败: #{name} - {str(e)}")
             sys.stdout.flush()
+            continue
+        if topic and all(existing['id'] != topic['id'] for existing in topics):
+            topics.append(topic)
+
+    # 改写会让正文变长（已通过长度校验），超出 MAX_CONTENT_LENGTH 的部分保持原样，话题仍会挂到笔记上
+    resolved_names = {topic['name'].lower() for topic in topics}
+    budget = [MAX_CONTENT_LENGTH - len(content)]
+
+    def rewrite(match):
+        replacement = f"#{match.group(1)}[话题]#"
+        growth = len(replacement) - len(match.group(0))
+        if match.group(1).lower() not in resolved_names or growth > budget[0]:
+            return match.group(0)
+        budget[0] -= growth
+        return replacement
+
+    content = HASHTAG_PATTERN.sub(rewrite, content)
+
+    logger.info(f"🏷️ 话题解析完成: {[topic['name'] for topic in topics]}")
+    sys.stdout.flush()
+    return topics, content
+
+
+# ========== 请求校验 ==========
+
+class PublishError(Exception):
+    """发布流程中可预期的错误，携带 HTTP 状态码、响应体和可选的响应头"""
+
+    def __init__(self, status_code: int, payload: dict, headers: dict = None):
+        super().__init__(payload.get('error', ''))
+        self.status_code = status_code
+        self.payload = {'success': False, **payload}
+        self.headers = headers or {}
+
+
+# 小红书图文笔记的限制
+MAX_IMAGES_PER_NOTE = 9
+MIN_CONTENT_LENGTH = 4
+MAX_CONTENT_LENGTH = 1000
+
+
+def validate_note_payload(data) -> dict:
+    """
+    校验请求体并提取笔记字段（纯本地检查，不发起任何网络请求）
+    
+    所有问题一次性收集到 errors 中返回，error 字段为第一个问题，
+    校验失败时抛出 PublishError(400)。
+    """
+    if not data or not isinstance(data, dict):
+        logger.error("请求体为空或不是 JSON 对象")
+        sys.stdout.flush()
+        raise PublishError(400, {'error': 'Request body is required'})
+
+    errors = []
+    title = data.get('title')
+    content = data.get('content')
+    image_url = data.get('image_url')
+    image_urls = data.get('image_urls', [])
+    is_private = data.get('is_private', False)
+    auto_topics = data.get('auto_topics', os.environ.get('XHS_AUTO_TOPICS') == '1')
+
+    if not title:
+        errors.append('title is required')
+    elif not isinstance(title, str) or not title.strip():
+        errors.append('title must be a non-empty string')
+
+    if not content:
+        errors.append('content is required')
+    elif not isinstance(content, str):
+        errors.append('content must be a string')
+    elif len(content) < MIN_CONTENT_LENGTH:
+        errors.append(f'content too short, minimum {MIN_CONTENT_LENGTH} characters required')
+    elif len(content) > MAX_CONTENT_LENGTH:
+        errors.append(f'content too long, maximum {MAX_CONTENT_LENGTH} characters allowed')
+
+    if not isinstance(is_private, bool):
+        errors.append('is_private must be a boolean')
+
+    if not isinstance(auto_topics, bool):
+        errors.append('auto_topics must be a boolean')
+
+    if image_url:
+        urls = [image_url]
+    elif isinstance(image_urls, list):
+        urls = image_urls
+    else:
+        urls = []
+        errors.append('image_urls must be a list of URLs')
+
+    if not urls:
+        errors.append('At least one image is required for XHS note')
+    elif len(urls) > MAX_IMAGES_PER_NOTE:
+        errors.append(f'Too many images: {len(urls)}, maximum {MAX_IMAGES_PER_NOTE} allowed')
+
+    for idx, url in enumerate(urls):
+        parsed = urlparse(url) if isinstance(url, str) else None
+        if not parsed or parsed.scheme not in ('http', 'https') or not parsed.netloc:
+            errors.append(f'Image {idx + 1} is not a valid http(s) URL: {url}')
+
+    if errors:
+        logger.error(f"❌ 请求校验失败: {errors}")
+        sys.stdout.flush()
+        raise PublishError(400, {'error': errors[0], 'errors': errors})
+
+    return {
+        'title': title,
+        'content': content,
+        'image_urls': urls,
+        'is_private': is_private,
+        'auto_topics': auto_topics,
+    }
+
+
+def probe_image_url(url: str, timeout: float, max_bytes: int):
+    """探测单张图片是否可访问、类型和大小是否合法，返回错误信息或 None"""
+    try:
+        response = requests.head(url, timeout=timeout, allow_redirects=True)
+        if response.status_code in (403, 405, 501):
+            # 部分图床不支持 HEAD，退化为只读取响应头的 GET
+            response = requests.get(url, timeout=timeout, stream=True)
+            response.close()
+    except Exception as e:
+        return f'unreachable ({type(e).__name__}: {e})'
+
+    if response.status_code >= 400:
+        return f'HTTP {response.status_code}'
+
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if content_type and not content_type.startswith('image/') and content_type != 'application/octet-stream':
+        return f'not an image (Content-Type: {content_type})'
+
+    content_length = response.headers.get('Content-Length')
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        return f'too large ({int(content_length)} bytes, maximum {max_bytes})'
+
+    return None
+
+
+def probe_image_urls(urls: list):
+    """并行探测所有图片 URL，任意一张不合法时抛出 PublishError(400)"""
+    if not urls or os.environ.get('XHS_IMAGE_PROBE', '1') == '0':
+        return
+
+    timeout = float(os.environ.get('XHS_IMAGE_PROBE_TIMEOUT', '5'))
+    max_bytes = int(os.environ.get('XHS_MAX_IMAGE_BYTES', str(20 * 1024 * 1024)))
+    started = time.time()
+
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        results = list(executor.map(lambda url: probe_image_url(url, timeout, max_bytes), urls))
+
+    errors = [f'Image {idx + 1} {error}: {url}' for idx, (url, error) in enumerate(zip(urls, results)) if error]
+    logger.info(f"🔍 图片探测完成：{len(urls) - len(errors)}/{len(urls)} 张可用，耗时 {time.time() - started:.2f}秒")
+    sys.stdout.flush()
+
+    if errors:
+        logger.error(f"❌ 图片探测失败: {errors}")
+        sys.stdout.flush()
+        raise PublishError(400, {'error': errors[0], 'errors': errors})
+
+
+# ========== 幂等与限流 ==========
+
+# 幂等记录：处理中的占位记录在异常退出时最多保留 10 分钟，完成的结果保留 24 小时
+IDEMPOTENCY_IN_PROGRESS_TTL = 600
+IDEMPOTENCY_TTL = 24 * 3600
+
+
+def begin_idempotent_request(account_key: str, idempotency_key: str) -> tuple:
+    """
+    登记一个带 Idempotency-Key 的请求，返回 (state_key, 已完成的记录或 None)
+    
+    同一个 key 的请求正在处理中时抛出 PublishError(409)。
+    """
+    state_key = f'idem:{account_key}:{idempotency_key}'
+    backend = get_state_backend()
+    if backend.set_if_absent(state_key, {'status': 'in_progress'}, ttl=IDEMPOTENCY_IN_PROGRESS_TTL):
+        return state_key, None
+
+    record = backend.get(state_key)
+    if record and record.get('status') == 'done':
+        logger.info(f"♻️ 幂等重放: Idempotency-Key={idempotency_key}")
+        sys.stdout.flush()
+        return state_key, record
+
+    raise PublishError(409, {'error': 'A request with this Idempotency-Key is already in progress'})
+
+
+def finish_idempotent_request(state_key: str, body: dict, status_code: int):
+    """成功的响应保存下来供重放；失败则删除记录，允许客户端用同一个 key 重试"""
+    backend = get_state_backend()
+    if 200 <= status_code < 300:
+        backend.set(state_key, {'status': 'done', 'body': body, 'status_code': status_code}, ttl=IDEMPOTENCY_TTL)
+    else:
+        backend.delete(state_key)
+
+
+def check_account_rate_limit(account_key: str):
+    """
+    按账号的固定窗口限流：XHS_ACCOUNT_RATE_WINDOW 秒内最多 XHS_ACCOUNT_RATE_LIMIT 次发布
+    
+    计数器在共享状态后端中，多个 worker / 实例合计；超限时抛出 PublishError(429)。
+    """
+    limit = int(os.environ.get('XHS_ACCOUNT_RATE_LIMIT', '0'))
+    if limit <= 0:
+        return
+
+    window = float(os.environ.get('XHS_ACCOUNT_RATE_WINDOW', '3600'))
+    now = time.time()
+    window_index = int(now // window)
+    count = get_state_backend().incr(f'rate:{account_key}:{window_index}', ttl=window)
+    if count > limit:
+        retry_after = int((window_index + 1) * window - now) + 1
+        logger.warning(f"⚠️ 账号 {account_key} 发布过于频繁（{count}/{limit}），{retry_after} 秒后重试")
+        sys.stdout.flush()
+        raise PublishError(429, {
+            'error': 'Too many publishes for this account',
+            'message': f'At most {limit} publishes per {int(window)} seconds',
+            'retry_after': retry_after
+        }, headers={'Retry-After': str(retry_after)})
+
+
+# ========== 发布流程 ==========
+
+def get_sign_server_url() -> str:
+    """读取签名服务器地址（必须配置）"""
+    sign_server_url = os.environ.get('XHS_SIGN_SERVER_URL', '')
+
+    if not sign_server_url:
+        logger.error("❌ 未配置 XHS_SIGN_SERVER_URL 环境变量")
+        logger.error("请先启动签名服务器并设置环境变量")
+        logger.error("")
+        logger.error("启动步骤：")
+        logger.error("  1. 启动签名服务器: python sign_server.py")
+        logger.error("  2. 设置环境变量: set XHS_SIGN_SERVER_URL=http://localhost:5005")
+        logger.error("  3. 启动发布服务器: python app.py")
+        logger.error("")
+        logger.error("或者使用快捷脚本: start_all.bat (Windows) 或 ./start_all.sh (Linux/Mac)")
+        logger.error("")
+        logger.error("详细文档: README_SIGN_SERVER.md")
+        sys.stdout.flush()
+        raise PublishError(500, {
+            'error': 'XHS_SIGN_SERVER_URL environment variable is required',
+            'message': 'Please start sign_server.py first and set XHS_SIGN_SERVER_URL environment variable',
+            'hint': 'Run: python sign_server.py, then set XHS_SIGN_SERVER_URL=http://localhost:5005'
+        })
+
+    logger.info(f"✅ 使用外部签名服务: {sign_server_url}")
+    sys.stdout.flush()
+    return sign_server_url
+
+
+def fetch_web_a1(sign_server_url: str) -> str:
+    """获取签名端 a1（结果在共享状态后端缓存 XHS_WEB_A1_TTL 秒）"""
+    ttl_seconds = float(os.environ.get('XHS_WEB_A1_TTL', '300'))
+    cache_key = f'web_a1:{sign_server_url}'
+    if ttl_seconds > 0:
+        web_a1 = get_state_backend().get(cache_key)
+        if web_a1:
+            logger.info(f"♻️ 使用缓存的签名端 a1: {web_a1[:30]}...")
+            sys.stdout.flush()
+            return web_a1
+
+    def request_web_a1():
+        logger.info(f"📡 正在从签名服务器获取 a1...")
+        sys.stdout.flush()
+
+        try:
+            response = requests.get(f"{sign_server_url}/web_a1", timeout=10)
+            response.raise_for_status()
+            web_a1 = response.json().get('web_a1')
+        except Exception as e:
+            logger.error(f"❌ 获取签名端 a1 失败: {e}")
+            sys.stdout.flush()
+            raise PublishError(500, {
+                'error': 'Failed to get web_a1 from sign server',
+                'message': str(e)
+            })
+
+        if not web_a1:
+            logger.error(f"❌ 签名服务器返回的 web_a1 为空")
+            logger.error(f"   响应: {response.text[:200]}")
+            sys.stdout.flush()
+            raise PublishError(500, {
+                'error': 'Failed to get web_a1 from sign server',
+                'message': 'Sign server returned empty web_a1'
+            })
+
+        logger.info(f"✅ 签名端 a1: {web_a1[:30]}...")
+        sys.stdout.flush()
+        if ttl_seconds > 0:
+            get_state_backend().set(cache_key, web_a1, ttl=ttl_seconds)
+        return web_a1
+
+    # 并发请求共享同一次获取
+    return SINGLE_FLIGHT['web_a1'].do(sign_server_url, request_web_a1)
+
+
+def create_external_sign(sign_server_url: str, cookie_a1: str, cookie_web_session: str, cookie_web_id: str):
+    """创建供 XhsClient 使用的外部签名函数"""
+    # 签名缓存放在共享状态后端，签名带时间戳，只短时间复用
+    sign_cache_ttl = float(os.environ.get('XHS_SIGN_CACHE_TTL', '30'))
+    sign_request_count = [0]  # 使用列表以便在闭包中修改
+
+    def external_sign(uri, data=None, a1="", web_session=""):
+        """
+        调用外部签名服务（带重试机制和智能缓存）
         
-        # 5. 验证是否有图片
-        if not image_files:
-            logger.error("小红书笔记必须包含至少一张图片")
+        注意：发布笔记需要多次签名是正常的！
+        - 获取上传凭证（/api/media/v1/upload/web/permit）
+        - 上传图片（可能需要签名）
+        - 发布笔记（/web_api/sns/v2/note）
+        每个请求的 URI 和 data 不同，签名也必须不同，不能重用！
+        
+        优化策略：
+        - 对于相同的 uri + data + 身份，使用缓存（跨请求、跨 worker 共享，避免重复请求）
+        - 失败后才重试，成功的签名直接使用
+        """
+        # 如果 XhsClient 没有传递，使用从 Cookie 中提取的值
+        actual_a1 = a1 if a1 else cookie_a1
+        actual_web_session = web_session if web_session else cookie_web_session
+        actual_web_id = cookie_web_id
+        
+        # 生成缓存键（基于 uri、data 和签名身份）
+        cache_key = 'sign:' + hashlib.md5(
+            f"{uri}:{json.dumps(data, sort_keys=True)}:{actual_a1}:{actual_web_session}:{actual_web_id}".encode()
+        ).hexdigest()
+        
+        # 检查缓存
+        if sign_cache_ttl > 0:
+            cached_signs = get_state_backend().get(cache_key)
+            if cached_signs:
+                logger.info(f"♻️ 使用缓存的签名 - URI: {uri}")
+                sys.stdout.flush()
+                return cached_signs
+        
+        def request_sign():
+            # 增加请求计数
+            sign_request_count[0] += 1
+            request_num = sign_request_count[0]
+        
+            max_retries = SIGN_MAX_RETRIES
+            last_error = None
+        
+            for attempt in range(max_retries):
+                try:
+                    logger.info(f"📝 [签名请求 #{request_num}] [尝试 {attempt + 1}/{max_retries}] URI: {uri}")
+                    sys.stdout.flush()
+                
+                    started = time.time()
+                    try:
+                        response = requests.post(
+                            f"{sign_server_url}/sign",
+                            json={
+                                "uri": uri,
+                                "data": data,
+                                "a1": actual_a1,
+                                "web_session": actual_web_session,
+                                "web_id": actual_web_id
+                            },
+                            timeout=SIGN_REQUEST_TIMEOUT
+                        )
+                    finally:
+                        # 超时和失败也计入延迟，签名服务器过载时能及时收紧准入
+                        admission_controller.observe_latency('sign', time.time() - started)
+                    response.raise_for_status()
+                    signs = response.json()
+                
+                    # 检查返回格式
+                    if 'x-s' not in signs or 'x-t' not in signs:
+                        raise ValueError(f"签名服务返回格式错误: {signs}")
+                
+                    # 缓存成功的签名
+                    if sign_cache_ttl > 0:
+                        get_state_backend().set(cache_key, signs, ttl=sign_cache_ttl)
+                
+                    logger.info(f"✅ [签名请求 #{request_num}] 签名获取成功")
+                    sys.stdout.flush()
+                    return signs
+                
+                except Exception as e:
+                    last_error = e
+                    logger.warning(f"❌ [签名请求 #{request_num}] [尝试 {attempt + 1}/{max_retries}] 失败: {str(e)}")
+                    sys.stdout.flush()
+                
+                    if attempt < max_retries - 1:
+                        wait_time = 1 * (attempt + 1)
+                        logger.info(f"⏳ 等待 {wait_time} 秒后重试...")
+                        sys.stdout.flush()
+                        time.sleep(wait_time)
+        
+            # 所有重试都失败
+            logger.error(f"💥 [签名请求 #{request_num}] 重试 {max_retries} 次后仍然失败")
+            sys.stdout.flush()
+            raise last_error
+        
+        # 并发的相同签名请求共享同一次调用
+        return SINGLE_FLIGHT['sign'].do(cache_key, request_sign)
+
+    return external_sign
+
+
+def create_xhs_client(cookie: str) -> XhsClient:
+    """初始化小红书客户端（签名服务 + a1 替换），失败时抛出 PublishError(500)"""
+    try:
+        logger.info("正在初始化小红书客户端...")
+        sys.stdout.flush()
+        
+        sign_server_url = get_sign_server_url()
+        
+        # 从 Cookie 中提取必需的三个字段
+        cookie_dict = parse_cookie(cookie)
+        cookie_a1 = cookie_dict.get('a1', '')
+        cookie_web_session = cookie_dict.get('web_session', '')
+        cookie_web_id = cookie_dict.get('webId', '')
+        
+        logger.info(f"📝 从 Cookie 提取认证信息:")
+        logger.info(f"   a1: {cookie_a1[:20]}...")
+        logger.info(f"   web_session: {cookie_web_session[:20]}...")
+        logger.info(f"   webId: {cookie_web_id[:20]}...")
+        sys.stdout.flush()
+        
+        external_sign = create_external_sign(sign_server_url, cookie_a1, cookie_web_session, cookie_web_id)
+        web_a1 = fetch_web_a1(sign_server_url)
+        
+        # 修复：必须把 replace 的返回值赋值回 cookie！
+        if cookie_a1 and web_a1:
+            logger.info(f"🔄 正在替换 cookie 中的 a1 字段")
+            logger.info(f"   原 a1: {cookie_a1[:30]}...")
+            logger.info(f"   新 a1: {web_a1[:30]}...")
+            cookie = cookie.replace(cookie_a1, web_a1)
+            logger.info(f"✅ cookie 中的 a1 已更新")
+        else:
+            logger.warning(f"⚠️ 无法替换 a1: cookie_a1={bool(cookie_a1)}, web_a1={bool(web_a1)}")
+        
+        logger.info(f"✅ 更新后 cookie: {cookie[:80]}...")
+        sys.stdout.flush()
+
+        # 创建客户端（必须提供 sign 参数）
+        client = XhsClient(cookie=cookie, sign=external_sign, timeout=XHS_REQUEST_TIMEOUT)
+        
+        logger.info("✅ 小红书客户端初始化成功")
+        logger.info(f"Client 类型: {type(client)}")
+        logger.info(f"External sign 函数: {client.external_sign}")
+        sys.stdout.flush()
+        
+        # 验证 create_note 方法是否存在和可调用
+        if not hasattr(client, 'create_note'):
+            logger.error("❌ XhsClient 没有 create_note 方法")
+            logger.error("可能是 xhs 库版本不兼容,请检查 requirements.txt")
             sys.stdout.flush()
-            return jsonify({
-                'success': False,
-                'error': 'At least one image is required for XHS note'
-            }), 400
-        
-        # 6. 发布笔记
-        @retry_on_failure(max_retries=3, delay=2)
-        def publish_note():
-            logger.info("=" * 60)
-            logger.info("开始发布笔记到小红书")
-            logger.info("=" * 60)
+            raise PublishError(500, {
+                'error': 'XhsClient does not have create_note method',
+                'message': 'Please check xhs library version'
+            })
+        
+        create_method = getattr(client, 'create_note', None)
+        if create_method is None or not callable(create_method):
+            logger.error(f"❌ create_note 不可调用: {create_method}")
             sys.stdout.flush()
+            raise PublishError(500, {
+                'error': 'create_note method is not callable'
+            })
             
-            truncated_title = title[:20]
-            if len(title) > 20:
-                logger.warning(f"⚠️ 标题被截断: {title} -> {truncated_title}")
-                sys.stdout.flush()
+        logger.info("✅ create_note 方法验证通过")
+        sys.stdout.flush()
+        return client
+        
+    except PublishError:
+        raise
+    except Exception as e:
+        logger.error(f"❌ 小红书客户端初始化失败: {str(e)}", exc_info=True)
+        sys.stdout.flush()
+        raise PublishError(500, {
+            'error': f'Failed to initialize XHS client: {str(e)}',
+            'error_type': type(e).__name__,
+            'hint': 'Please check XHS_SIGN_SERVER_URL environment variable'
+        })
+
+
+def fetch_image(url: str) -> bytes:
+    """下载图片内容（并发下载同一个 URL 时只请求一次）"""
+    def request_image():
+        response = requests.get(url, timeout=IMAGE_DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        return response.content
+
+    return SINGLE_FLIGHT['image'].do(url, request_image)
+
+
+def download_images(urls: list) -> list:
+    """下载图片到临时文件，返回成功下载的文件路径（单张失败只记录警告）"""
+    image_files = []
+    if not urls:
+        return image_files
+
+    logger.info(f"开始下载 {len(urls)} 张图片")
+    sys.stdout.flush()
+    
+    for idx, url in enumerate(urls):
+        try:
+            logger.info(f"下载图片 {idx + 1}/{len(urls)}: {url}")
+            sys.stdout.flush()
+            content = fetch_image(url)
             
-            logger.info(f"📋 笔记参数：")
-            logger.info(f"  • 标题: {truncated_title}")
-            logger.info(f"  • 内容: {content[:100]}{'...' if len(content) > 100 else ''}")
-            logger.info(f"  • 内容长度: {len(content)} 字符")
-            logger.info(f"  • 图片数量: {len(image_files)}")
-            logger.info(f"  • 私密笔记: {is_private}")
+            ext = Path(url).suffix or '.jpg'
+            if ext.lower() not in ['.jpg', '.jpeg', '.png', '.gif', '.webp']:
+                ext = '.jpg'
             
-            # 验证内容
-            if len(content) < 4:
-                logger.error("❌ 内容太短，小红书要求至少 4 个字符")
-                raise ValueError("Content too short, minimum 4 characters required")
+            temp_file = tempfile.NamedTemporaryFile(
+                mode='wb', 
+                suffix=ext, 
+                delete=False
+            )
+            temp_file.write(content)
+            temp_file.close()
             
-            if len(truncated_title) < 1:
-                logger.error("❌ 标题不能为空")
-                raise ValueError("Title cannot be empty")
+            image_files.append(temp_file.name)
             
+            logger.info(f"图片 {idx + 1} 下载成功，大小: {len(content)} bytes")
+            sys.stdout.flush()
+        except Exception as e:
+            logger.warning(f"图片 {idx + 1} 处理失败: {str(e)}")
             sys.stdout.flush()
+    
+    logger.info(f"成功下载 {len(image_files)}/{len(urls)} 张图片")
+    sys.stdout.flush()
+    return image_files
+
+
+def cleanup_temp_files(temp_files: list):
+    """清理临时文件"""
+    logger.info(f"开始清理 {len(temp_files)} 个临时文件")
+    sys.stdout.flush()
+    
+    for temp_file in temp_files:
+        try:
+            if os.path.exists(temp_file):
+                os.unlink(temp_file)
+                logger.info(f"已清理临时文件: {temp_file}")
+        except Exception as e:
+            logger.warning(f"清理临时文件失败: {str(e)}")
+    
+    sys.stdout.flush()
+
+
+@retry_on_failure(max_retries=PUBLISH_MAX_RETRIES, delay=PUBLISH_RETRY_DELAY)
+def publish_image_note(client: XhsClient, title: str, content: str, images: list, is_private: bool = False,
+                       topics: list = None):
+    """使用已上传的图片发布图文笔记（失败自动重试）"""
+    logger.info("=" * 60)
+    logger.info("开始发布笔记到小红书")
+    logger.info("=" * 60)
+    sys.stdout.flush()
+    
+    truncated_title = title[:20]
+    if len(title) > 20:
+        logger.warning(f"⚠️ 标题被截断: {title} -> {truncated_title}")
+        sys.stdout.flush()
+    
+    logger.info(f"📋 笔记参数：")
+    logger.info(f"  • 标题: {truncated_title}")
+    logger.info(f"  • 内容: {content[:100]}{'...' if len(content) > 100 else ''}")
+    logger.info(f"  • 内容长度: {len(content)} 字符")
+    logger.info(f"  • 图片数量: {len(images)}")
+    logger.info(f"  • 私密笔记: {is_private}")
+    logger.info(f"  • 话题: {[topic['name'] for topic in topics or []]}")
+    sys.stdout.flush()
+    
+    logger.info("📡 发布笔记内容（需要签名）")
+    sys.stdout.flush()
+    
+    try:
+        # 调用发布方法（图片已由 upload_images 上传）
+        started = time.time()
+        result = client.create_note(
+            truncated_title,         # title
+            content,                 # desc
+            NoteType.NORMAL.value,   # note_type
+            topics=topics,
+            image_info={"images": images},
+            is_private=is_private
+        )
+        admission_controller.observe_latency('xhs', time.time() - started)
+        
+        logger.info(f"✅ 小红书 API 返回: {result}")
+        sys.stdout.flush()
+        return result
+        
+    except Exception as e:
+        # 详细的错误日志
+        logger.error("=" * 60)
+        logger.error(f"❌ 发布失败！错误类型: {type(e).__name__}")
+        logger.error(f"❌ 错误信息: {str(e)}")
+        
+        # 如果是 DataFetchError，提取详细信息
+        if hasattr(e, 'args') and len(e.args) > 0:
+            error_data = e.args[0]
+            if isinstance(error_data, dict):
+                logger.error(f"❌ 错误代码: {error_data.get('code', 'unknown')}")
+                logger.error(f"❌ 错误消息: {error_data.get('msg', 'no message')}")
+                
+                # 根据错误代码提供建议
+                code = error_data.get('code')
+                if code == -1:
+                    logger.error("💡 code: -1 可能原因：")
+                    logger.error("   1. 内容违规（敏感词、广告等）")
+                    logger.error("   2. 图片格式或大小问题")
+                    logger.error("   3. 标题或内容格式不符合要求")
+                    logger.error("   4. 请求过于频繁")
+                    logger.error("   5. Cookie 已过期或无效")
+                elif code == -100:
+                    logger.error("💡 code: -100 表示无登录信息，请检查 Cookie")
+                elif code == 300012:
+                    logger.error("💡 code: 300012 表示需要验证码")
+        
+        logger.error("=" * 60)
+        sys.stdout.flush()
+        raise
+
+
+def build_note_response(result) -> dict:
+    """从小红书返回结果中提取笔记 ID 和链接"""
+    note_id = result.get('note_id') or result.get('id')
+    if not note_id:
+        logger.error(f"返回结果中没有找到 note_id: {result}")
+        sys.stdout.flush()
+        raise ValueError('Failed to get note_id from response')
+    
+    note_url = f"https://www.xiaohongshu.com/explore/{note_id}"
+    
+    logger.info(f"笔记发布成功! ID: {note_id}, URL: {note_url}")
+    sys.stdout.flush()
+    
+    return {
+        'success': True,
+        'note_id': note_id,
+        'note_url': note_url
+    }
+
+
+def build_error_response(e: Exception) -> dict:
+    """构建详细的错误响应（包含小红书错误码和处理建议）"""
+    error_response = {
+        'success': False,
+        'error': str(e),
+        'error_type': type(e).__name__
+    }
+    
+    # 如果是 DataFetchError，提取小红书的错误信息
+    if hasattr(e, 'args') and len(e.args) > 0:
+        error_data = e.args[0]
+        if isinstance(error_data, dict):
+            error_response['xhs_error'] = error_data
+            error_response['xhs_code'] = error_data.get('code')
+            error_response['xhs_msg'] = error_data.get('msg', '')
+            
+            # 根据错误代码提供建议
+            code = error_data.get('code')
+            suggestions = []
             
-            # 记录即将开始的 API 调用流程
-            logger.info("📡 开始 API 调用流程：")
-            logger.info("  步骤1: 获取图片上传凭证（需要签名）")
-            logger.info("  步骤2: 上传图片文件")
-            logger.info("  步骤3: 发布笔记内容（需要签名）")
+            if code == -1:
+                suggestions = [
+                    "检查内容是否包含敏感词或广告",
+                    "检查图片格式是否正确（支持 jpg、png、gif、webp）",
+                    "检查标题和内容长度是否符合要求",
+                    "尝试降低请求频率",
+                    "重新获取 Cookie（可能已过期）"
+                ]
+            elif code == -100:
+                suggestions = [
+                    "Cookie 无效或已过期",
+                    "请重新登录小红书并获取新的 Cookie",
+                    "确保 Cookie 包含 a1、web_session、webId 三个字段"
+                ]
+            elif code == 300012:
+                suggestions = [
+                    "触发了验证码机制",
+                    "降低请求频率",
+                    "等待一段时间后再试"
+                ]
+            
+            if suggestions:
+                error_response['suggestions'] = suggestions
+    
+    return error_response
+
+
+def prepare_note(client: XhsClient, cookie: str, note: dict, image_files: list = None) -> dict:
+    """
+    发布前的准备阶段：下载图片 → 解析话题 → 上传图片
+    
+    返回可 JSON 序列化的 prepared 字典，交给 commit_note 完成发布（可以间隔一段时间，见草稿接口）。
+    image_files 不为空时直接使用已预先下载好的图片（调用方负责清理）。
+    """
+    temp_files = []
+    try:
+        if image_files is None:
+            image_files = temp_files = download_images(note['image_urls'])
+
+        if not image_files:
+            logger.error("小红书笔记必须包含至少一张图片")
+            sys.stdout.flush()
+            raise PublishError(400, {'error': 'At least one image is required for XHS note'})
+
+        topics, content = [], note['content']
+        if note.get('auto_topics'):
+            topics, content = attach_topics(client, content)
+        
+        account_key = get_account_key(cookie)
+        images, upload_stats = upload_images(client, image_files, account_key)
+        return {
+            'account_key': account_key,
+            'title': note['title'],
+            'content': content,
+            'topics': topics,
+            'images': images,
+            'image_urls': note['image_urls'],
+            'is_private': note['is_private'],
+            'upload_stats': upload_stats,
+        }
+    finally:
+        if temp_files:
+            cleanup_temp_files(temp_files)
+
+
+def reupload_images(client: XhsClient, prepared: dict, image_files: list = None):
+    """重新上传 prepared 中的图片（失效的缓存条目需先作废），原地更新 images 和 upload_stats"""
+    temp_files = []
+    try:
+        if image_files is None:
+            image_files = temp_files = download_images(prepared['image_urls'])
+        if not image_files:
+            raise PublishError(502, {'error': 'Failed to re-download images for re-upload'})
+        prepared['images'], prepared['upload_stats'] = upload_images(client, image_files, prepared['account_key'])
+    finally:
+        if temp_files:
+            cleanup_temp_files(temp_files)
+
+
+def commit_note(client: XhsClient, prepared: dict, image_files: list = None, refresh_all: bool = False) -> dict:
+    """
+    发布阶段：只做签名和创建笔记，返回发布结果
+    
+    复用的 file_id 可能已在小红书侧失效：发布失败时作废这些缓存条目，重新上传后再发布一次
+    （refresh_all=True 时重新上传全部图片，用于存放了一段时间的草稿）。
+    重新上传会原地更新 prepared；image_files 为空时按 prepared['image_urls'] 重新下载。
+    """
+    def publish():
+        return publish_image_note(
+            client, prepared['title'], prepared['content'], prepared['images'],
+            is_private=prepared['is_private'], topics=prepared['topics']
+        )
+
+    upload_stats = prepared['upload_stats']
+    stale_hashes = upload_stats.get('hashes', upload_stats['cached_hashes']) if refresh_all else upload_stats['cached_hashes']
+    try:
+        result = publish()
+    except Exception as e:
+        cache = get_upload_cache()
+        if cache and stale_hashes:
+            cache.invalidate(prepared['account_key'], stale_hashes)
+        if not stale_hashes or not (image_files or prepared.get('image_urls')):
+            raise
+        logger.warning(f"⚠️ 发布失败（{str(e)}），复用的图片可能已失效，重新上传后再试一次")
+        sys.stdout.flush()
+        reupload_images(client, prepared, image_files)
+        result = publish()
+    
+    response = build_note_response(result)
+    upload_stats = prepared['upload_stats']
+    response['upload_cache'] = {
+        'hits': upload_stats['hits'],
+        'misses': upload_stats['misses'],
+        'bytes_saved': upload_stats['bytes_saved'],
+    }
+    return response
+
+
+def execute_publish(cookie: str, note: dict, image_files: list = None) -> dict:
+    """
+    完整的发布流程：初始化客户端 → 准备（下载、话题、上传图片）→ 发布笔记
+    
+    image_files 不为空时直接使用已预先下载好的图片（调用方负责清理）。
+    可预期的错误抛出 PublishError，其余异常原样抛出。
+    """
+    logger.info(f"笔记信息 - 标题: {note['title'][:20]}, 内容长度: {len(note['content'])}, 私密: {note['is_private']}")
+    sys.stdout.flush()
+
+    client = create_xhs_client(cookie)
+
+    # 记录即将开始的 API 调用流程
+    logger.info("📡 开始 API 调用流程：")
+    logger.info("  步骤1: 获取图片上传凭证并上传图片（内容相同的图片复用缓存）")
+    logger.info("  步骤2: 发布笔记内容（需要签名）")
+    sys.stdout.flush()
+
+    # 图片文件保留到发布结束，复用的图片失效需要重新上传时不必再下载
+    temp_files = []
+    try:
+        if image_files is None:
+            image_files = temp_files = download_images(note['image_urls'])
+        prepared = prepare_note(client, cookie, note, image_files=image_files)
+        return commit_note(client, prepared, image_files=image_files)
+    finally:
+        if temp_files:
+            cleanup_temp_files(temp_files)
+
+
+# ========== 定时发布 ==========
+
+# 随机偏移窗口上限（秒），以及 publish_at 允许早于当前时间的容差（秒）
+MAX_SCHEDULE_JITTER_SECONDS = 3600
+SCHEDULE_PAST_TOLERANCE_SECONDS = 60
+# publish_at 默认最多提前 30 天（XHS_SCHEDULE_MAX_AHEAD 可调整）
+DEFAULT_SCHEDULE_MAX_AHEAD_SECONDS = 30 * 86400
+
+
+def parse_publish_at(value) -> float:
+    """
+    解析定时发布时间，返回 Unix 时间戳（秒）
+    
+    支持：
+    - 数字：Unix 时间戳（秒或毫秒）
+    - 字符串：ISO 8601（如 2024-01-01T12:00:00+08:00）或 "2024-01-01 12:00:00"
+    不带时区的时间按服务器本地时区处理。
+    """
+    if isinstance(value, bool):
+        raise ValueError('publish_at must be a timestamp or ISO 8601 string')
+    if isinstance(value, (int, float)):
+        timestamp = float(value)
+        return timestamp / 1000 if timestamp > 1e12 else timestamp
+    if isinstance(value, str) and value.strip():
+        text = value.strip()
+        if text.endswith('Z'):
+            text = text[:-1] + '+00:00'
+        return datetime.fromisoformat(text).timestamp()
+    raise ValueError('publish_at must be a timestamp or ISO 8601 string')
+
+
+def format_timestamp(timestamp: float) -> str:
+    """把时间戳格式化为带时区的 ISO 8601 字符串"""
+    return datetime.fromtimestamp(timestamp).astimezone().isoformat(timespec='seconds')
+
+
+class PublishScheduler:
+    """
+    本地定时发布调度器
+    
+    - 任务按到期时间放入最小堆，由一个调度线程按时分发到工作线程池
+    - 每个任务有两个阶段：提前 prestage_seconds 秒初始化客户端、解析话题并上传图片（stage），
+      到点只做签名和创建笔记（publish）；预处理结果随任务持久化，失败时到点按完整流程发布
+    - 任务持久化到 JSON 文件，进程重启后未完成的任务会重新入堆
+    - 多个 worker 进程共用同一个任务文件：读写时加文件锁并合并其他进程的修改，
+      只有拿到调度锁的一个进程分发任务，其余进程每 poll_seconds 秒尝试接管
+    """
+
+    # 进程重启后只保留最近的已结束任务记录
+    MAX_FINISHED_JOBS = 200
+    # 合并任务文件时，状态更靠后的一方为准（cancelled / succeeded / failed 均为 3）
+    STATUS_RANK = {'pending': 0, 'staged': 1, 'running': 2}
+
+    def __init__(self, store_path: str, max_workers: int = 4, prestage_seconds: float = 300,
+                 poll_seconds: float = 5):
+        self.store_path = store_path
+        self.prestage_seconds = prestage_seconds
+        self.poll_seconds = poll_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='xhs-scheduler')
+        self._cond = threading.Condition()
+        self._heap = []  # (due_at, seq, job_id, phase)，只有调度进程维护
+        self._seq = 0
+        self._jobs = {}
+        self._staged_clients = {}  # job_id -> 预处理时初始化的客户端（不持久化）
+        self._thread = None
+        self._owner_file = None  # 持有调度锁的文件句柄（进程退出时自动释放）
+
+    @property
+    def is_dispatcher(self) -> bool:
+        return self._owner_file is not None
+
+    def start(self):
+        """加载持久化任务并启动调度线程"""
+        with self._cond:
+            if self._thread is not None:
+                return
+            if self._try_acquire_dispatcher():
+                self._recover()
+            else:
+                self._sync(write=False)
+            self._thread = threading.Thread(target=self._dispatch_loop, name='xhs-scheduler-dispatch', daemon=True)
+            self._thread.start()
+        role = '调度进程' if self.is_dispatcher else '非调度进程（任务由其他 worker 分发）'
+        logger.info(f"⏰ 定时发布调度器已启动（{role}），待发布任务: {self.pending_count()}，存储: {self.store_path}")
+        sys.stdout.flush()
+
+    def schedule(self, cookie: str, note: dict, publish_at: float, jitter_seconds: float = 0) -> dict:
+        """添加定时任务，实际分发时间 = publish_at + [0, jitter_seconds) 内的随机偏移"""
+        dispatch_at = publish_at + (random.uniform(0, jitter_seconds) if jitter_seconds > 0 else 0)
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'status': 'pending',
+            'publish_at': publish_at,
+            'dispatch_at': dispatch_at,
+            'created_at': time.time(),
+            'cookie': cookie,
+            'note': note,
+            'result': None,
+            'error': None,
+        }
+        # 先格式化：时间无法表示时在写入任务之前就抛出
+        view = self._public_view(job)
+        with self._cond:
+            self._jobs[job['job_id']] = job
+            if self.is_dispatcher:
+                self._enqueue(job)
+            self._sync()
+            self._cond.notify()
+
+        logger.info(f"⏰ 已添加定时任务 {job['job_id']}，计划发布时间: {view['dispatch_at']}")
+        sys.stdout.flush()
+        return view
+
+    def get(self, job_id: str):
+        with self._cond:
+            self._sync(write=False)
+            job = self._jobs.get(job_id)
+            return self._public_view(job) if job else None
+
+    def list_jobs(self) -> list:
+        with self._cond:
+            self._sync(write=False)
+            jobs = sorted(self._jobs.values(), key=lambda job: job['dispatch_at'])
+            return [self._public_view(job) for job in jobs]
+
+    def pending_count(self) -> int:
+        with self._cond:
+            self._sync(write=False)
+            return sum(1 for job in self._jobs.values() if job['status'] in ('pending', 'staged'))
+
+    def cancel(self, job_id: str) -> bool:
+        """取消尚未开始发布的任务（堆中的条目在出堆时被忽略）"""
+        def mark_cancelled():
+            job = self._jobs.get(job_id)
+            if not job or job['status'] not in ('pending', 'staged'):
+                return False
+            job['status'] = 'cancelled'
+            return True
+
+        with self._cond:
+            cancelled = self._sync(mark_cancelled)
+            if cancelled:
+                self._staged_clients.pop(job_id, None)
+        return cancelled
+
+    def _enqueue(self, job: dict):
+        if job['status'] == 'pending':
+            self._push(job['dispatch_at'] - self.prestage_seconds, job['job_id'], 'stage')
+        self._push(job['dispatch_at'], job['job_id'], 'publish')
+
+    def _push(self, due_at: float, job_id: str, phase: str):
+        self._seq += 1
+        heapq.heappush(self._heap, (due_at, self._seq, job_id, phase))
+
+    def _dispatch_loop(self):
+        while True:
+            try:
+                self._dispatch_next()
+            except Exception as e:
+                # 单个任务出错不能让调度线程退出，否则之后的任务都不会再执行
+                logger.error(f"❌ 定时任务调度出错: {str(e)}", exc_info=True)
+                sys.stdout.flush()
+                time.sleep(1)
+
+    def _dispatch_next(self):
+        """等待下一个到期的任务阶段并提交到线程池（非调度进程只定期尝试接管）"""
+        with self._cond:
+            if not self.is_dispatcher:
+                if not self._try_acquire_dispatcher():
+                    self._cond.wait(self.poll_seconds)
+                    return
+                logger.info("⏰ 已接管定时任务调度")
+                sys.stdout.flush()
+                self._recover()
+
+            if not self._heap or self._heap[0][0] > time.time():
+                # 最多等待 poll_seconds，以便及时看到其他进程新增或取消的任务
+                timeout = self._heap[0][0] - time.time() if self._heap else self.poll_seconds
+                self._cond.wait(min(timeout, self.poll_seconds, threading.TIMEOUT_MAX))
+                self._sync(write=False)
+                return
+
+            _, _, job_id, phase = heapq.heappop(self._heap)
+
+            def claim():
+                job = self._jobs.get(job_id)
+                if not job or job['status'] not in ('pending', 'staged'):
+                    return False
+                if phase == 'stage':
+                    return job['status'] == 'pending'
+                if phase == 'publish':
+                    job['status'] = 'running'
+                return True
+
+            # 发布阶段在文件锁内把状态改为 running，与其他进程的取消操作互斥
+            if not self._sync(claim, write=(phase == 'publish')):
+                return
+        self._executor.submit(self._stage if phase == 'stage' else self._run, job_id)
+
+    def _stage(self, job_id: str):
+        """
+        预处理：初始化客户端、解析话题、上传图片，到点时只剩签名和创建笔记
+        
+        预处理结果（prepared）随任务持久化；失败或繁忙时跳过，到点按完整流程发布。
+        """
+        with self._cond:
+            job = self._jobs[job_id]
+            cookie, note = job['cookie'], job['note']
+
+        if not admission_controller.acquire():
+            logger.warning(f"⚠️ 发布繁忙，定时任务 {job_id} 跳过预处理，到点按完整流程发布")
+            sys.stdout.flush()
+            return
+        logger.info(f"⏰ 预处理定时任务 {job_id}（客户端、话题、图片上传）")
+        sys.stdout.flush()
+        try:
+            client = create_xhs_client(cookie)
+            prepared = prepare_note(client, cookie, note)
+        except Exception as e:
+            logger.warning(f"⚠️ 定时任务 {job_id} 预处理失败，到点按完整流程发布: {str(e)}")
+            sys.stdout.flush()
+            return
+        finally:
+            admission_controller.release()
+
+        def mark_staged():
+            job = self._jobs.get(job_id)
+            if not job or job['status'] != 'pending':
+                return False  # 任务已被取消或已开始发布
+            job.update(status='staged', prepared=prepared)
+            self._staged_clients[job_id] = client
+            return True
+
+        with self._cond:
+            self._sync(mark_staged)
+
+    def _run(self, job_id: str):
+        with self._cond:
+            job = self._jobs[job_id]
+            prepared = job.get('prepared')
+            client = self._staged_clients.pop(job_id, None)
+
+        # 和接口请求共享并发发布名额；过载时到点的任务推迟执行，而不是直接失败
+        while not admission_controller.acquire():
+            retry_after = admission_controller.retry_after()
+            logger.warning(f"⚠️ 发布繁忙，定时任务 {job_id} 推迟 {retry_after} 秒")
+            sys.stdout.flush()
+            time.sleep(retry_after)
+
+        logger.info(f"⏰ 开始执行定时任务 {job_id}（{'已预处理' if prepared else '未预处理，完整发布'}）")
+        sys.stdout.flush()
+
+        try:
+            if prepared:
+                # 图片上传于 prestage_seconds 之前，file_id 失效时 commit_note 会重新上传
+                client = client or create_xhs_client(job['cookie'])
+                result = commit_note(client, prepared, refresh_all=True)
+            else:
+                result = execute_publish(job['cookie'], job['note'])
+            status, error = 'succeeded', None
+        except PublishError as e:
+            result, status, error = None, 'failed', e.payload
+        except Exception as e:
+            logger.error(f"❌ 定时任务 {job_id} 发布失败: {str(e)}", exc_info=True)
+            sys.stdout.flush()
+            result, status, error = None, 'failed', build_error_response(e)
+        finally:
+            admission_controller.release()
+
+        with self._cond:
+            self._sync(lambda: job.update(status=status, result=result, error=error, finished_at=time.time()))
+
+        logger.info(f"⏰ 定时任务 {job_id} 结束，状态: {status}")
+        sys.stdout.flush()
+
+    def _try_acquire_dispatcher(self) -> bool:
+        """尝试获取调度锁（非阻塞），同一时刻只有一个进程分发任务"""
+        if self._owner_file is not None:
+            return True
+        owner_file = open(f"{self.store_path}.dispatch.lock", 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(owner_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                owner_file.close()
+                return False
+        self._owner_file = owner_file
+        return True
+
+    def _recover(self):
+        """成为调度进程后，处理上一个调度进程遗留的任务并重建堆（调用方需持有锁）"""
+        def recover():
+            self._heap = []
+            for job in self._jobs.values():
+                if job['status'] == 'staged' and not job.get('prepared'):
+                    job['status'] = 'pending'
+                elif job['status'] == 'running':
+                    # 进程在发布途中退出，无法确认是否已发布，不自动重试以免重复发帖
+                    job.update(status='failed', error={'success': False, 'error': 'Interrupted by process restart'},
+                               finished_at=time.time())
+                if job['status'] in ('pending', 'staged'):
+                    self._enqueue(job)
+
+        self._sync(recover)
+
+    @contextmanager
+    def _store_lock(self):
+        """跨进程互斥地读写任务文件"""
+        with open(f"{self.store_path}.lock", 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _sync(self, mutate=None, write: bool = True):
+        """
+        加文件锁：读取任务文件并与内存合并 → 执行 mutate → 写回（调用方需持有 self._cond）
+        
+        返回 mutate 的返回值。所有修改都在同一把文件锁内完成，多个进程不会互相覆盖。
+        """
+        with self._store_lock():
+            self._merge(self._read_store())
+            result = mutate() if mutate else None
+            if write:
+                self._write_store()
+        return result
+
+    def _merge(self, jobs: list):
+        """合并文件中的任务：新任务加入内存，状态更靠后的版本覆盖内存中的旧版本"""
+        for remote in jobs:
+            local = self._jobs.get(remote['job_id'])
+            if local is None:
+                self._jobs[remote['job_id']] = remote
+                if self.is_dispatcher and remote['status'] in ('pending', 'staged'):
+                    self._enqueue(remote)
+            elif self._rank(remote) > self._rank(local):
+                local.update(remote)  # 原地更新，工作线程持有的引用保持有效
+
+        # 已被其他进程取消的任务，丢弃预处理时初始化的客户端
+        for job_id in [job_id for job_id in self._staged_clients if self._jobs.get(job_id, {}).get('status') != 'staged']:
+            self._staged_clients.pop(job_id)
+
+    def _rank(self, job: dict) -> int:
+        return self.STATUS_RANK.get(job['status'], 3)
+
+    def _read_store(self) -> list:
+        if not os.path.exists(self.store_path):
+            return []
+        try:
+            with open(self.store_path, 'r', encoding='utf-8') as f:
+                jobs = json.load(f)
+        except Exception as e:
+            logger.error(f"❌ 读取定时任务文件失败: {e}")
+            sys.stdout.flush()
+            return []
+
+        valid_jobs = []
+        for job in jobs:
+            try:
+                self._public_view(job)
+            except (KeyError, TypeError, ValueError, OverflowError, OSError) as e:
+                logger.warning(f"⚠️ 跳过无效的定时任务 {job.get('job_id')}: {str(e)}")
+                sys.stdout.flush()
+                continue
+            valid_jobs.append(job)
+        return valid_jobs
+
+    def _write_store(self):
+        """原子写入任务文件（调用方需持有文件锁）"""
+        active = [job for job in self._jobs.values() if job['status'] in ('pending', 'staged', 'running')]
+        finished = sorted(
+            (job for job in self._jobs.values() if job['status'] not in ('pending', 'staged', 'running')),
+            key=lambda job: job.get('finished_at') or job['created_at']
+        )[-self.MAX_FINISHED_JOBS:]
+        self._jobs = {job['job_id']: job for job in active + finished}
+
+        temp_path = f"{self.store_path}.tmp"
+        try:
+            # 任务文件包含完整 Cookie，只允许当前用户读写
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(active + finished, f, ensure_ascii=False)
+            os.replace(temp_path, self.store_path)
+        except Exception as e:
+            logger.error(f"❌ 保存定时任务文件失败: {e}")
+            sys.stdout.flush()
+
+    @staticmethod
+    def _public_view(job: dict) -> dict:
+        """对外展示的任务信息（不包含 Cookie）"""
+        return {
+            'job_id': job['job_id'],
+            'status': job['status'],
+            'title': job['note']['title'],
+            'publish_at': format_timestamp(job['publish_at']),
+            'dispatch_at': format_timestamp(job['dispatch_at']),
+            'result': job['result'],
+            'error': job['error'],
+        }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> PublishScheduler:
+    """获取（并按需启动）全局定时发布调度器"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = PublishScheduler(
+                store_path=os.environ.get('XHS_SCHEDULE_FILE') or os.path.join(tempfile.gettempdir(), 'xhs_schedule.json'),
+                max_workers=int(os.environ.get('XHS_SCHEDULER_WORKERS', '4')),
+                prestage_seconds=float(os.environ.get('XHS_SCHEDULE_PRESTAGE_SECONDS', '300')),
+                poll_seconds=float(os.environ.get('XHS_SCHEDULE_POLL_SECONDS', '5')),
+            )
+            _scheduler.start()
+        return _scheduler
+
+
+# ========== 草稿（两阶段发布） ==========
+
+DRAFT_GC_INTERVAL = 60
+_last_draft_gc = [0.0]  # 使用列表以便在函数中修改
+
+
+def collect_expired_drafts():
+    """定期清理共享状态后端中过期的草稿等条目（最多每 DRAFT_GC_INTERVAL 秒一次）"""
+    now = time.time()
+    if now - _last_draft_gc[0] < DRAFT_GC_INTERVAL:
+        return
+    _last_draft_gc[0] = now
+    purged = get_state_backend().purge_expired()
+    if purged:
+        logger.info(f"🧹 已清理 {purged} 条过期状态（草稿、缓存等）")
+        sys.stdout.flush()
+
+
+def create_draft(cookie: str, note: dict, ttl_seconds: float) -> dict:
+    """
+    准备阶段：现在就下载、处理并上传图片，把结果存为草稿
+    
+    草稿只保存上传后的 file_id 等信息，到期自动失效；提交时只需签名和创建笔记。
+    """
+    client = create_xhs_client(cookie)
+    prepared = prepare_note(client, cookie, note)
+
+    token = secrets.token_urlsafe(24)
+    expires_at = time.time() + ttl_seconds
+    get_state_backend().set(f'draft:{token}', {**prepared, 'expires_at': expires_at}, ttl=ttl_seconds)
+    collect_expired_drafts()
+
+    logger.info(f"📝 草稿已创建，{len(prepared['images'])} 张图片已上传，有效期 {int(ttl_seconds)} 秒")
+    sys.stdout.flush()
+    return {
+        'success': True,
+        'draft_token': token,
+        'expires_at': format_timestamp(expires_at),
+        'image_count': len(prepared['images']),
+        'topics': [topic['name'] for topic in prepared['topics']],
+        'upload_cache': {
+            'hits': prepared['upload_stats']['hits'],
+            'misses': prepared['upload_stats']['misses'],
+            'bytes_saved': prepared['upload_stats']['bytes_saved'],
+        },
+    }
+
+
+def draft_commit_budget(image_count: int) -> float:
+    """
+    草稿提交在所有外部请求都超时时的最长耗时（秒），用作提交锁的有效期
+    
+    包括：初始化客户端 → 发布（含重试）→ 重新下载并上传图片（含重试）→ 再发布一次
+    """
+    def with_retries(attempt_seconds):
+        backoff = sum(PUBLISH_RETRY_DELAY * 2 ** i for i in range(PUBLISH_MAX_RETRIES - 1))
+        return PUBLISH_MAX_RETRIES * attempt_seconds + backoff
+
+    # 一次需要签名的小红书请求：签名（含重试和等待）+ 请求本身
+    signed_call = SIGN_MAX_RETRIES * SIGN_REQUEST_TIMEOUT + sum(range(1, SIGN_MAX_RETRIES)) + XHS_REQUEST_TIMEOUT
+    publish = with_retries(signed_call)
+    reupload = image_count * IMAGE_DOWNLOAD_TIMEOUT + with_retries(image_count * (signed_call + XHS_REQUEST_TIMEOUT))
+    return XHS_REQUEST_TIMEOUT + 2 * publish + reupload
+
+
+def commit_draft(cookie: str, token: str) -> dict:
+    """提交阶段：只签名并创建笔记，成功后删除草稿（失败时保留，可重试）"""
+    backend = get_state_backend()
+    draft = backend.get(f'draft:{token}')
+    if not draft:
+        raise PublishError(404, {'error': 'Draft not found or expired'})
+    if draft['account_key'] != get_account_key(cookie):
+        raise PublishError(403, {'error': 'Draft belongs to a different account'})
+
+    # 防止同一草稿被并发提交两次；锁在最慢的提交结束前不能过期
+    lock_key = f'draft_lock:{token}'
+    if not backend.set_if_absent(lock_key, True, ttl=draft_commit_budget(len(draft['images']))):
+        raise PublishError(409, {'error': 'Draft is already being published'})
+    try:
+        # 拿到锁后重新读取：上一个提交可能在我们读取之后已发布并删除了草稿
+        draft = backend.get(f'draft:{token}')
+        if not draft:
+            raise PublishError(404, {'error': 'Draft not found or expired'})
+        client = create_xhs_client(cookie)
+        images_before = draft['images']
+        try:
+            response = commit_note(client, draft, refresh_all=True)
+        except Exception:
+            if draft['images'] is not images_before:
+                # 图片已重新上传：保存新的 file_id，下次提交不再使用失效的旧图片
+                backend.set(f'draft:{token}', draft, ttl=max(1, draft['expires_at'] - time.time()))
+            raise
+        backend.delete(f'draft:{token}')
+        return response
+    finally:
+        backend.delete(lock_key)
+        collect_expired_drafts()
+
+
+# ========== 多账号分发 ==========
+
+MAX_FANOUT_STAGGER_SECONDS = 600
+
+def resolve_fanout_accounts(entries, accounts_token: str = None) -> list:
+    """
+    解析分发目标：字符串为账号 ID（查 XHS_ACCOUNTS_FILE），对象为 {"cookie": "..."}
+    
+    返回 [{label, cookie, account_key}]，任何一项不合法都抛出 PublishError，不会发布任何账号。
+    """
+    max_accounts = int(os.environ.get('XHS_FANOUT_MAX_ACCOUNTS', '50'))
+    if not isinstance(entries, list) or not entries:
+        raise PublishError(400, {'error': 'accounts must be a non-empty list'})
+    if len(entries) > max_accounts:
+        raise PublishError(400, {'error': f'At most {max_accounts} accounts per fan-out request'})
+
+    accounts = None
+    if any(isinstance(entry, str) for entry in entries):
+        # 账号 ID 可以代替 Cookie 发布，必须配置并校验访问令牌
+        expected_token = os.environ.get('XHS_ACCOUNTS_TOKEN')
+        if not expected_token:
+            raise PublishError(400, {'error': 'Account IDs are disabled: XHS_ACCOUNTS_TOKEN is not configured'})
+        if not accounts_token or not secrets.compare_digest(accounts_token, expected_token):
+            raise PublishError(401, {'error': 'Invalid or missing X-Accounts-Token header'})
+        accounts_file = os.environ.get('XHS_ACCOUNTS_FILE')
+        if not accounts_file:
+            raise PublishError(400, {'error': 'Account IDs require XHS_ACCOUNTS_FILE to be configured'})
+        try:
+            accounts = load_accounts(accounts_file)
+        except (OSError, ValueError) as e:
+            raise PublishError(500, {'error': f'Failed to load accounts file: {str(e)}'})
+
+    targets = []
+    seen = set()
+    for idx, entry in enumerate(entries):
+        if isinstance(entry, str):
+            if entry not in accounts:
+                raise PublishError(400, {'error': f'Unknown account: {entry}'})
+            cookie, label = accounts[entry], entry
+        elif isinstance(entry, dict) and isinstance(entry.get('cookie'), str):
+            cookie, label = entry['cookie'], None
+        else:
+            raise PublishError(400, {'error': f'accounts[{idx}] must be an account ID or {{"cookie": "..."}}'})
+
+        if not validate_cookie(cookie):
+            raise PublishError(400, {'error': f'accounts[{idx}]: invalid cookie, missing required fields'})
+        account_key = get_account_key(cookie)
+        if account_key in seen:
+            raise PublishError(400, {'error': f'accounts[{idx}]: duplicate account'})
+        seen.add(account_key)
+        targets.append({'label': label or account_key, 'cookie': cookie, 'account_key': account_key})
+    return targets
+
+
+def publish_to_account(target: dict, note: dict, image_files: list, start_at: float,
+                       stop_event: threading.Event) -> dict:
+    """分发到单个账号（独立的客户端、准入名额和限流计数），返回结果记录，不抛异常"""
+    record = {'account': target['label']}
+    if stop_event.wait(max(0, start_at - time.time())):
+        return {**record, 'success': False, 'status_code': 499, 'error': 'Fan-out cancelled'}
+    if not admission_controller.acquire():
+        return {**record, 'success': False, 'status_code': 429,
+                'error': 'Server is busy, please retry later', 'retry_after': admission_controller.retry_after()}
+    try:
+        check_account_rate_limit(target['account_key'])
+        client = create_xhs_client(target['cookie'])
+        prepared = prepare_note(client, target['cookie'], note, image_files=image_files)
+        return {**record, 'status_code': 200, **commit_note(client, prepared, image_files=image_files)}
+    except PublishError as e:
+        return {**record, 'success': False, 'status_code': e.status_code, **e.payload}
+    except Exception as e:
+        logger.error(f"❌ 账号 {target['label']} 分发失败: {type(e).__name__}: {str(e)}")
+        sys.stdout.flush()
+        return {**record, 'status_code': 500, **build_error_response(e)}
+    finally:
+        admission_controller.release()
+
+
+def fan_out_publish(targets: list, note: dict, image_files: list, stagger_seconds: float = 0):
+    """
+    把同一篇笔记并发发布到多个账号，按完成顺序逐个产出结果记录
+    
+    图片只下载一次（image_files 由调用方准备和清理），上传仍按账号进行（file_id 与账号绑定）。
+    第 i 个账号最早在开始后 i * stagger_seconds 秒发布；单个账号失败不影响其他账号。
+    """
+    workers = min(int(os.environ.get('XHS_FANOUT_WORKERS', '4')), len(targets))
+    started = time.time()
+    stop_event = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='xhs-fanout')
+    try:
+        futures = [
+            executor.submit(publish_to_account, target, note, image_files,
+                            started + idx * stagger_seconds, stop_event)
+            for idx, target in enumerate(targets)
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # 客户端断开时不再开始新的账号，但要等进行中的发布结束（之后才能清理图片）
+        stop_event.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+# ========== 性能分析 ==========
+
+PROFILING_ENABLED = os.environ.get('XHS_PROFILING_ENABLED') == '1'
+PROFILE_DIR = os.environ.get('XHS_PROFILE_DIR') or os.path.join(tempfile.gettempdir(), 'xhs_profiles')
+PROFILE_MAX_COUNT = int(os.environ.get('XHS_PROFILE_MAX_COUNT', '20'))
+PROFILE_FILE_SUFFIXES = {'prof': '.prof', 'stats': '.stats.txt', 'memory': '.memory.txt'}
+
+# tracemalloc 是进程级的，同一时间只分析一个请求
+_profile_lock = threading.Lock()
+
+
+def list_profile_ids() -> list:
+    """已保存的分析结果 ID，最新的在前"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    # 按写入时间排序（同一秒内的多份结果只靠 ID 无法区分先后）
+    entries = [entry for entry in os.scandir(PROFILE_DIR) if entry.name.endswith('.prof')]
+    entries.sort(key=lambda entry: (entry.stat().st_mtime_ns, entry.name), reverse=True)
+    return [entry.name[:-len('.prof')] for entry in entries]
+
+
+def prune_profiles():
+    """只保留最近 PROFILE_MAX_COUNT 份分析结果"""
+    for profile_id in list_profile_ids()[PROFILE_MAX_COUNT:]:
+        for suffix in PROFILE_FILE_SUFFIXES.values():
+            path = os.path.join(PROFILE_DIR, profile_id + suffix)
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+def profile_request(func):
+    """
+    按请求分析耗时和内存分配的装饰器
+    
+    仅当 XHS_PROFILING_ENABLED=1 时生效，且只分析带 X-Profile: 1 请求头的请求；
+    未开启时直接返回原函数，没有任何额外开销。
+    结果（cProfile + tracemalloc 快照差异）写入 XHS_PROFILE_DIR，profile ID 通过 X-Profile-Id 响应头返回。
+    """
+    if not PROFILING_ENABLED:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if request.headers.get('X-Profile') != '1':
+            return func(*args, **kwargs)
+        if not _profile_lock.acquire(blocking=False):
+            logger.warning("⚠️ 已有请求正在分析，本次请求不做分析")
             sys.stdout.flush()
-            
+            return func(*args, **kwargs)
+
+        now = time.time()
+        profile_id = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}{int(now % 1 * 1000):03d}-{uuid.uuid4().hex[:8]}"
+        profiler = cProfile.Profile()
+        started_tracing = not tracemalloc.is_tracing()
+        try:
+            if started_tracing:
+                tracemalloc.start(25)
+            snapshot_before = tracemalloc.take_snapshot()
+            started = time.time()
+
+            profiler.enable()
             try:
-                # 调用发布方法
-                result = client.create_image_note(
-                    truncated_title,  # title
-                    content,           # desc
-                    image_files,       # files
-                    is_private=is_private
-                )
-                
-                logger.info(f"✅ 小红书 API 返回: {result}")
-                sys.stdout.flush()
-                return result
-                
+                rv = func(*args, **kwargs)
+            finally:
+                profiler.disable()
+                elapsed = time.time() - started
+                snapshot_after = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                if started_tracing:
+                    tracemalloc.stop()
+
+            # 请求已经处理完（笔记可能已发布），写分析结果失败只记录警告，不能把响应变成 500
+            try:
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                base_path = os.path.join(PROFILE_DIR, profile_id)
+                profiler.dump_stats(base_path + PROFILE_FILE_SUFFIXES['prof'])
+
+                with open(base_path + PROFILE_FILE_SUFFIXES['stats'], 'w', encoding='utf-8') as f:
+                    f.write(f"{request.method} {request.path} - {elapsed:.3f}s\n\n")
+                    pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(60)
+
+                with open(base_path + PROFILE_FILE_SUFFIXES['memory'], 'w', encoding='utf-8') as f:
+                    f.write(f"{request.method} {request.path} - current {current} bytes, peak {peak} bytes\n\n")
+                    for stat in snapshot_after.compare_to(snapshot_before, 'lineno')[:40]:
+                        f.write(f"{stat}\n")
             except Exception as e:
-                # 详细的错误日志
-                logger.error("=" * 60)
-                logger.error(f"❌ 发布失败！错误类型: {type(e).__name__}")
-                logger.error(f"❌ 错误信息: {str(e)}")
-                
-                # 如果是 DataFetchError，提取详细信息
-                if hasattr(e, 'args') and len(e.args) > 0:
-                    error_data = e.args[0]
-                    if isinstance(error_data, dict):
-                        logger.error(f"❌ 错误代码: {error_data.get('code', 'unknown')}")
-                        logger.error(f"❌ 错误消息: {error_data.get('msg', 'no message')}")
-                        
-                        # 根据错误代码提供建议
-                        code = error_data.get('code')
-                        if code == -1:
-                            logger.error("💡 code: -1 可能原因：")
-                            logger.error("   1. 内容违规（敏感词、广告等）")
-                            logger.error("   2. 图片格式或大小问题")
-                            logger.error("   3. 标题或内容格式不符合要求")
-                            logger.error("   4. 请求过于频繁")
-                            logger.error("   5. Cookie 已过期或无效")
-                        elif code == -100:
-                            logger.error("💡 code: -100 表示无登录信息，请检查 Cookie")
-                        elif code == 300012:
-                            logger.error("💡 code: 300012 表示需要验证码")
-                
-                logger.error("=" * 60)
+                logger.warning(f"⚠️ 写入请求分析结果失败: {str(e)}")
                 sys.stdout.flush()
-                raise
-        
-        result = publish_note()
-        
-        note_id = result.get('note_id') or result.get('id')
-        if not note_id:
-            logger.error(f"返回结果中没有找到 note_id: {result}")
+                return rv
+
+            try:
+                prune_profiles()
+            except Exception as e:
+                logger.warning(f"⚠️ 清理旧的请求分析结果失败: {str(e)}")
+            logger.info(f"🔬 请求分析完成: {profile_id}（耗时 {elapsed:.3f}秒，内存峰值 {peak} bytes）")
             sys.stdout.flush()
-            raise ValueError('Failed to get note_id from response')
+        finally:
+            _profile_lock.release()
+
+        response = make_response(rv)
+        response.headers['X-Profile-Id'] = profile_id
+        return response
+
+    return wrapper
+
+
+# ========== 全局错误处理器 ==========
+
+@app.errorhandler(Exception)
+def handle_exception(e):
+    """捕获所有未处理的异常"""
+    logger.error("=" * 50)
+    logger.error(f"未捕获的异常: {type(e).__name__}")
+    logger.error(f"错误信息: {str(e)}", exc_info=True)
+    logger.error("=" * 50)
+    sys.stdout.flush()  # 强制刷新日志
+    
+    return jsonify({
+        'success': False,
+        'error': f'Internal server error: {str(e)}',
+        'error_type': type(e).__name__
+    }), 500
+
+
+@app.errorhandler(404)
+def handle_404(e):
+    """处理 404 错误"""
+    logger.warning(f"404 错误 - 路径: {request.path}")
+    sys.stdout.flush()
+    
+    return jsonify({
+        'success': False,
+        'error': 'Endpoint not found',
+        'path': request.path
+    }), 404
+
+
+@app.errorhandler(400)
+def handle_400(e):
+    """处理 400 错误"""
+    logger.warning(f"400 错误: {str(e)}")
+    sys.stdout.flush()
+    
+    return jsonify({
+        'success': False,
+        'error': 'Bad request',
+        'message': str(e)
+    }), 400
+
+
+@app.before_request
+def log_request():
+    """记录每个请求"""
+    logger.info(f"收到请求 [{request.method}] {request.path}")
+    logger.info(f"来源 IP: {request.remote_addr}")
+    logger.info(f"User-Agent: {request.headers.get('User-Agent', 'Unknown')}")
+    sys.stdout.flush()
+
+
+@app.after_request
+def log_response(response):
+    """记录每个响应"""
+    logger.info(f"响应状态码: {response.status_code}")
+    sys.stdout.flush()
+    return response
+
+
+@app.get('/')
+def index():
+    """API 根路径"""
+    logger.info("访问根路径")
+    sys.stdout.flush()
+    return jsonify({
+        'message': 'XiaoHongShu Publish API',
+        'version': '1.0.0',
+        'status': 'running',
+        'endpoints': {
+            'health': '/api/health',
+            'publish': '/api/publish',
+            'schedule': '/api/schedule',
+            'drafts': '/api/drafts',
+            'fanout': '/api/fanout'
+        }
+    })
+
+
+@app.get('/api/health')
+def health():
+    """健康检查接口"""
+    return jsonify({
+        'status': 'healthy',
+        'service': 'xiaohongshu-publish-api',
+        'version': '1.0.0',
+        'scheduled_pending': _scheduler.pending_count() if _scheduler else 0,
+        'upload_cache': _upload_cache.stats() if _upload_cache else None,
+        'state_backend': _state_backend.name if _state_backend else None,
+        'single_flight': {name: group.stats() for name, group in SINGLE_FLIGHT.items()},
+        'admission': admission_controller.stats()
+    })
+
+
+def get_request_cookie() -> str:
+    """从请求头读取并验证 Cookie，失败时抛出 PublishError"""
+    cookie = request.headers.get('X-XHS-Cookie')
+    if not cookie:
+        logger.error("请求缺少 X-XHS-Cookie header")
+        sys.stdout.flush()
+        raise PublishError(400, {'error': 'X-XHS-Cookie header is required'})
+    
+    logger.info(f"收到发布请求，Cookie: {mask_cookie(cookie)}")
+    sys.stdout.flush()
+    
+    if not validate_cookie(cookie):
+        logger.error("Cookie 格式无效或缺少必要字段")
+        sys.stdout.flush()
+        raise PublishError(401, {
+            'error': 'Invalid cookie: missing required fields',
+            'message': 'Cookie must contain: a1, web_session, and webId',
+            'hint': 'Please get complete cookie from xiaohongshu.com while logged in'
+        })
+    return cookie
+
+
+def parse_schedule_options(data: dict):
+    """解析定时发布参数，非定时请求返回 None，参数非法时抛出 PublishError(400)"""
+    if data.get('publish_at') is None:
+        return None
+    
+    try:
+        publish_at = parse_publish_at(data.get('publish_at'))
+        jitter_seconds = float(data.get('jitter_seconds') or 0)
+    except (TypeError, ValueError, OverflowError) as e:
+        raise PublishError(400, {'error': f'Invalid publish_at or jitter_seconds: {str(e)}'})
+    
+    if not math.isfinite(publish_at):
+        raise PublishError(400, {'error': 'publish_at must be a finite timestamp'})
+    
+    if not 0 <= jitter_seconds <= MAX_SCHEDULE_JITTER_SECONDS:
+        raise PublishError(400, {'error': f'jitter_seconds must be between 0 and {MAX_SCHEDULE_JITTER_SECONDS}'})
+    
+    if publish_at < time.time() - SCHEDULE_PAST_TOLERANCE_SECONDS:
+        raise PublishError(400, {'error': 'publish_at is in the past'})
+    
+    max_ahead_seconds = float(os.environ.get('XHS_SCHEDULE_MAX_AHEAD', str(DEFAULT_SCHEDULE_MAX_AHEAD_SECONDS)))
+    if publish_at > time.time() + max_ahead_seconds:
+        raise PublishError(400, {'error': f'publish_at must be within {int(max_ahead_seconds)} seconds from now'})
+    
+    return publish_at, jitter_seconds
+
+
+@app.post('/api/publish')
+@profile_request
+def publish():
+    """小红书笔记发布接口（带 publish_at 时为定时发布）"""
+    logger.info("开始处理发布请求")
+    sys.stdout.flush()
+    
+    headers = {}
+    idempotency_key = None
+    try:
+        # 1. 获取并验证 Cookie
+        cookie = get_request_cookie()
+        account_key = get_account_key(cookie)
         
-        note_url = f"https://www.xiaohongshu.com/explore/{note_id}"
+        # 2. 校验请求体（纯本地检查），不合法的请求不触发任何网络请求
+        data = request.get_json(silent=True)
+        note = validate_note_payload(data)
+        schedule_options = parse_schedule_options(data)
         
-        logger.info(f"笔记发布成功! ID: {note_id}, URL: {note_url}")
-        sys.stdout.flush()
+        # 3. 立即发布占用发布名额（定时发布到点后由调度器占用）
+        with nullcontext() if schedule_options else admission_slot():
+            # 4. 幂等：相同 Idempotency-Key 的重复请求直接返回第一次的结果
+            if request.headers.get('Idempotency-Key'):
+                idempotency_key, record = begin_idempotent_request(account_key, request.headers['Idempotency-Key'])
+                if record:
+                    return jsonify(record['body']), record['status_code'], {'Idempotent-Replayed': 'true'}
+            
+            # 5. 并行探测图片
+            probe_image_urls(note['image_urls'])
+            
+            if schedule_options:
+                # 6a. 定时发布：交给调度器，到点后再签名和发布
+                publish_at, jitter_seconds = schedule_options
+                job = get_scheduler().schedule(cookie, note, publish_at, jitter_seconds)
+                body, status_code = {'success': True, 'scheduled': True, **job}, 202
+            else:
+                # 6b. 立即发布
+                check_account_rate_limit(account_key)
+                body, status_code = execute_publish(cookie, note), 200
         
-        return jsonify({
-            'success': True,
-            'note_id': note_id,
-            'note_url': note_url
-        })
+    except PublishError as e:
+        body, status_code, headers = e.payload, e.status_code, e.headers
         
     except Exception as e:
         logger.error("=" * 50)
@@ -655,65 +2607,163 @@ def publish():
         logger.error("=" * 50)
         sys.stdout.flush()
         
-        # 构建详细的错误响应
-        error_response = {
-            'success': False,
-            'error': str(e),
-            'error_type': type(e).__name__
-        }
+        body, status_code = build_error_response(e), 500
+    
+    if idempotency_key:
+        finish_idempotent_request(idempotency_key, body, status_code)
+    return jsonify(body), status_code, headers
+
+
+@app.post('/api/drafts')
+def create_draft_endpoint():
+    """创建草稿：提前完成图片下载、处理和上传，返回带有效期的草稿 token"""
+    logger.info("开始处理创建草稿请求")
+    sys.stdout.flush()
+    
+    try:
+        cookie = get_request_cookie()
+        data = request.get_json(silent=True)
+        note = validate_note_payload(data)
         
-        # 如果是 DataFetchError，提取小红书的错误信息
-        if hasattr(e, 'args') and len(e.args) > 0:
-            error_data = e.args[0]
-            if isinstance(error_data, dict):
-                error_response['xhs_error'] = error_data
-                error_response['xhs_code'] = error_data.get('code')
-                error_response['xhs_msg'] = error_data.get('msg', '')
-                
-                # 根据错误代码提供建议
-                code = error_data.get('code')
-                suggestions = []
-                
-                if code == -1:
-                    suggestions = [
-                        "检查内容是否包含敏感词或广告",
-                        "检查图片格式是否正确（支持 jpg、png、gif、webp）",
-                        "检查标题和内容长度是否符合要求",
-                        "尝试降低请求频率",
-                        "重新获取 Cookie（可能已过期）"
-                    ]
-                elif code == -100:
-                    suggestions = [
-                        "Cookie 无效或已过期",
-                        "请重新登录小红书并获取新的 Cookie",
-                        "确保 Cookie 包含 a1、web_session、webId 三个字段"
-                    ]
-                elif code == 300012:
-                    suggestions = [
-                        "触发了验证码机制",
-                        "降低请求频率",
-                        "等待一段时间后再试"
-                    ]
-                
-                if suggestions:
-                    error_response['suggestions'] = suggestions
+        try:
+            ttl_seconds = float(data.get('ttl_seconds') or os.environ.get('XHS_DRAFT_TTL', '3600'))
+        except (TypeError, ValueError):
+            raise PublishError(400, {'error': 'ttl_seconds must be a number'})
+        max_ttl_seconds = float(os.environ.get('XHS_DRAFT_MAX_TTL', '86400'))
+        if not 0 < ttl_seconds <= max_ttl_seconds:
+            raise PublishError(400, {'error': f'ttl_seconds must be between 1 and {int(max_ttl_seconds)}'})
         
-        return jsonify(error_response), 500
+        with admission_slot():
+            probe_image_urls(note['image_urls'])
+            return jsonify(create_draft(cookie, note, ttl_seconds)), 201
+        
+    except PublishError as e:
+        return jsonify(e.payload), e.status_code, e.headers
+        
+    except Exception as e:
+        logger.error(f"❌ 创建草稿失败: {type(e).__name__}: {str(e)}", exc_info=True)
+        sys.stdout.flush()
+        return jsonify(build_error_response(e)), 500
+
+
+@app.post('/api/drafts/<token>/publish')
+def publish_draft_endpoint(token):
+    """提交草稿：只做签名和创建笔记"""
+    logger.info("开始处理草稿发布请求")
+    sys.stdout.flush()
     
-    finally:
-        # 清理临时文件
-        logger.info(f"开始清理 {len(temp_files)} 个临时文件")
+    try:
+        cookie = get_request_cookie()
+        with admission_slot():
+            check_account_rate_limit(get_account_key(cookie))
+            return jsonify(commit_draft(cookie, token))
+        
+    except PublishError as e:
+        return jsonify(e.payload), e.status_code, e.headers
+        
+    except Exception as e:
+        logger.error(f"❌ 草稿发布失败: {type(e).__name__}: {str(e)}", exc_info=True)
         sys.stdout.flush()
+        return jsonify(build_error_response(e)), 500
+
+
+@app.post('/api/fanout')
+def fanout():
+    """多账号分发：一篇笔记发布到多个账号，以 NDJSON 流式返回每个账号的结果"""
+    logger.info("开始处理多账号分发请求")
+    sys.stdout.flush()
+    
+    try:
+        data = request.get_json(silent=True)
+        note = validate_note_payload(data)
+        if data.get('publish_at') is not None:
+            raise PublishError(400, {'error': 'publish_at is not supported for fan-out'})
+        try:
+            stagger_seconds = float(data.get('stagger_seconds') or 0)
+        except (TypeError, ValueError):
+            raise PublishError(400, {'error': 'stagger_seconds must be a number'})
+        if not 0 <= stagger_seconds <= MAX_FANOUT_STAGGER_SECONDS:
+            raise PublishError(400, {'error': f'stagger_seconds must be between 0 and {MAX_FANOUT_STAGGER_SECONDS}'})
+        targets = resolve_fanout_accounts(data.get('accounts'), request.headers.get('X-Accounts-Token'))
         
-        for temp_file in temp_files:
-            try:
-                if os.path.exists(temp_file):
-                    os.unlink(temp_file)
-                    logger.info(f"已清理临时文件: {temp_file}")
-            except Exception as e:
-                logger.warning(f"清理临时文件失败: {str(e)}")
+        # 图片只探测、下载一次，所有账号共用
+        probe_image_urls(note['image_urls'])
+        image_files = download_images(note['image_urls'])
+        if not image_files:
+            raise PublishError(400, {'error': 'At least one image is required for XHS note'})
         
+    except PublishError as e:
+        return jsonify(e.payload), e.status_code, e.headers
+    
+    logger.info(f"📣 分发到 {len(targets)} 个账号，{len(image_files)} 张图片")
+    sys.stdout.flush()
+    
+    def generate():
+        counts = {'succeeded': 0, 'failed': 0}
+        yield json.dumps({'type': 'start', 'accounts': len(targets), 'images': len(image_files)}) + '\n'
+        for record in fan_out_publish(targets, note, image_files, stagger_seconds):
+            counts['succeeded' if record.get('success') else 'failed'] += 1
+            yield json.dumps({'type': 'result', **record}, ensure_ascii=False) + '\n'
+        logger.info(f"📊 分发完成：成功 {counts['succeeded']}，失败 {counts['failed']}")
         sys.stdout.flush()
+        yield json.dumps({'type': 'summary', **counts}) + '\n'
+    
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    response.call_on_close(lambda: cleanup_temp_files(image_files))
+    return response
+
+
+@app.get('/api/schedule')
+def list_scheduled():
+    """列出定时发布任务"""
+    return jsonify({'success': True, 'jobs': get_scheduler().list_jobs()})
+
+
+@app.get('/api/schedule/<job_id>')
+def get_scheduled(job_id):
+    """查询定时发布任务状态"""
+    job = get_scheduler().get(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Scheduled job not found'}), 404
+    return jsonify({'success': True, **job})
+
+
+@app.delete('/api/schedule/<job_id>')
+def cancel_scheduled(job_id):
+    """取消尚未发布的定时任务"""
+    if not get_scheduler().cancel(job_id):
+        return jsonify({'success': False, 'error': 'Scheduled job not found or already started'}), 409
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'cancelled'})
+
+
+@app.get('/api/profiles')
+def list_profiles():
+    """列出已保存的请求分析结果（需开启 XHS_PROFILING_ENABLED）"""
+    profile_ids = list_profile_ids() if PROFILING_ENABLED else []
+    return jsonify({
+        'success': True,
+        'enabled': PROFILING_ENABLED,
+        'profiles': [
+            {'profile_id': profile_id, 'files': {kind: f'/api/profiles/{profile_id}/{kind}' for kind in PROFILE_FILE_SUFFIXES}}
+            for profile_id in profile_ids
+        ]
+    })
+
+
+@app.get('/api/profiles/<profile_id>/<kind>')
+def get_profile(profile_id, kind):
+    """下载分析结果：prof（cProfile 原始数据）、stats（耗时汇总）、memory（内存分配差异）"""
+    suffix = PROFILE_FILE_SUFFIXES.get(kind)
+    path = os.path.join(PROFILE_DIR, os.path.basename(profile_id) + suffix) if suffix else None
+    if not PROFILING_ENABLED or not path or not os.path.exists(path):
+        return jsonify({'success': False, 'error': 'Profile not found'}), 404
+    return send_file(path, as_attachment=(kind == 'prof'), mimetype='application/octet-stream' if kind == 'prof' else 'text/plain')
+
+
+# 常驻进程启动时即恢复未完成的定时任务，否则重启后要等到有人访问定时接口才会继续分发；
+# Vercel 等无常驻进程的环境默认不启动，也可以设置 XHS_SCHEDULER_AUTOSTART=0 关闭
+if os.environ.get('XHS_SCHEDULER_AUTOSTART', '0' if os.environ.get('VERCEL') else '1') == '1':
+    get_scheduler()
 
 
 # Vercel 需要这个
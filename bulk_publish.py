@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+批量发布工具
+在进程内复用 app.py 的发布流程，从 JSONL / CSV 文件流式读取笔记并发发布，
+每完成一行写入检查点，中断后重新运行会从上次停下的地方继续。
+
+用法：
+    python bulk_publish.py notes.jsonl --cookie "a1=xxx; web_session=xxx; webId=xxx" \\
+        --workers 4 --min-interval 30 --state notes.state --results notes.results.jsonl
+
+输入格式：
+- JSONL：每行一个对象，字段与 /api/publish 请求体相同，另可带 account（账号 ID）或 cookie
+- CSV：表头包含 title, content, image_urls（多张用 | 分隔），可选 is_private, auto_topics, account, cookie
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+# 批量发布进程不参与定时任务调度（即使环境变量开启了自动启动）
+os.environ['XHS_SCHEDULER_AUTOSTART'] = '0'
+
+import app as publish_app
+
+
+def iter_rows(path):
+    """流式读取输入文件，逐行产出 (行号, 行数据)，不会一次性载入整个文件"""
+    if path.lower().endswith('.csv'):
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            for row_number, row in enumerate(csv.DictReader(f), 1):
+                yield row_number, parse_csv_row(row)
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            row_number = 0
+            for line in f:
+                if not line.strip():
+                    continue
+                row_number += 1
+                try:
+                    yield row_number, json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield row_number, {'_parse_error': f'Invalid JSON: {e}'}
+
+
+def parse_csv_row(row):
+    """把 CSV 行转换为与 /api/publish 请求体相同的结构"""
+    def parse_bool(value):
+        return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+    data = {
+        'title': row.get('title', ''),
+        'content': row.get('content', ''),
+        'image_urls': [url.strip() for url in (row.get('image_urls') or '').split('|') if url.strip()],
+    }
+    for field in ('is_private', 'auto_topics'):
+        if row.get(field):
+            data[field] = parse_bool(row[field])
+    for field in ('account', 'cookie'):
+        if row.get(field):
+            data[field] = row[field]
+    return data
+
+
+def row_hash(data):
+    """行内容的哈希，用于确认检查点记录的仍是同一行"""
+    return hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False).encode()).hexdigest()[:16]
+
+
+class Checkpoint:
+    """
+    检查点文件：每完成一行追加一条 {"row": n, "hash": ..., "status": ...}
+
+    追加写入 + 逐行 flush，进程崩溃最多丢失正在处理中的行。
+    记录行内容的哈希，输入文件在两次运行之间被修改时可以发现，而不是按行号跳过或重复发布。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}  # 行号 -> (哈希, 状态)
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # 崩溃时写了一半的行
+                    self.completed[record['row']] = (record.get('hash'), record['status'])
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def find_mismatches(self, rows):
+        """返回内容与检查点记录不一致的行号（旧版检查点没有哈希，不做比较）"""
+        mismatches = []
+        for row_number, data in rows:
+            recorded_hash = self.completed.get(row_number, (None, None))[0]
+            if recorded_hash and recorded_hash != row_hash(data):
+                mismatches.append(row_number)
+        return mismatches
+
+    def is_done(self, row_number, retry_failed=False):
+        status = self.completed.get(row_number, (None, None))[1]
+        return status == 'succeeded' or (status == 'failed' and not retry_failed)
+
+    def mark(self, row_number, data, status):
+        digest = row_hash(data)
+        with self._lock:
+            self.completed[row_number] = (digest, status)
+            self._file.write(json.dumps({'row': row_number, 'hash': digest, 'status': status}) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class ResultWriter:
+    """结果文件（JSONL），边处理边追加"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class AccountPacer:
+    """按账号节流：同一账号两次发布之间至少间隔 min_interval 秒，不同账号互不影响"""
+
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._next_allowed = {}
+        self._lock = threading.Lock()
+
+    def wait(self, account_key, stop_event):
+        """预约该账号的下一个发布时间点并等待到点，收到停止信号时返回 False"""
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next_allowed.get(account_key, 0))
+            self._next_allowed[account_key] = slot + self.min_interval
+        return not stop_event.wait(max(0, slot - time.time()))
+
+
+def resolve_cookie(data, default_cookie, accounts):
+    """行内 cookie > 行内 account（查账号文件）> 命令行 --cookie"""
+    if data.get('cookie'):
+        return data['cookie']
+    if data.get('account'):
+        if data['account'] not in accounts:
+            raise publish_app.PublishError(400, {'error': f"Unknown account: {data['account']}"})
+        return accounts[data['account']]
+    if default_cookie:
+        return default_cookie
+    raise publish_app.PublishError(400, {'error': 'No cookie or account for this row'})
+
+
+def publish_row(row_number, data, default_cookie, accounts, pacer, stop_event):
+    """发布一行，返回结果记录（不抛异常）"""
+    record = {'row': row_number, 'title': data.get('title')}
+    try:
+        if '_parse_error' in data:
+            raise publish_app.PublishError(400, {'error': data['_parse_error']})
+
+        cookie = resolve_cookie(data, default_cookie, accounts)
+        if not publish_app.validate_cookie(cookie):
+            raise publish_app.PublishError(401, {'error': 'Invalid cookie: missing required fields'})
+
+        note = publish_app.validate_note_payload(data)
+        publish_app.probe_image_urls(note['image_urls'])
+
+        account_key = publish_app.get_account_key(cookie)
+        record['account'] = data.get('account') or account_key
+        if not pacer.wait(account_key, stop_event):
+            return None
+
+        result = publish_app.execute_publish(cookie, note)
+        record.update(status='succeeded', note_id=result['note_id'], note_url=result['note_url'])
+    except publish_app.PublishError as e:
+        record.update(status='failed', error=e.payload)
+    except Exception as e:
+        record.update(status='failed', error=publish_app.build_error_response(e))
+    return record
+
+
+def run_bulk(args):
+    accounts = publish_app.load_accounts(args.accounts) if args.accounts else {}
+    checkpoint = Checkpoint(args.state or f"{args.input}.state")
+
+    # 输入文件在上次运行后被修改（重新导出、增删行）时，按行号续传会跳过或重复发布，直接退出
+    mismatches = checkpoint.find_mismatches(iter_rows(args.input))
+    if mismatches:
+        print(f"❌ 输入文件与检查点 {checkpoint.path} 不一致（第 {', '.join(map(str, mismatches[:10]))} 行"
+              f"{' 等' if len(mismatches) > 10 else ''}内容已变化），请恢复原文件或使用新的 --state", file=sys.stderr)
+        checkpoint.close()
+        return 2
+
+    results = ResultWriter(args.results or f"{args.input}.results.jsonl")
+    pacer = AccountPacer(args.min_interval)
+    stop_event = threading.Event()
+    rows = queue.Queue(maxsize=args.workers * 2)  # 有界队列：读取速度受发布速度约束
+    counts = {'succeeded': 0, 'failed': 0, 'skipped': 0}
+    counts_lock = threading.Lock()
+
+    def worker():
+        while True:
+            item = rows.get()
+            if item is None:
+                return
+            row_number, data = item
+            record = publish_row(row_number, data, args.cookie, accounts, pacer, stop_event)
+            if record is None:
+                continue  # 被中断，未发布，不写检查点
+            # 先写检查点再写结果：崩溃时宁可缺一条结果，也不重复发布
+            checkpoint.mark(row_number, data, record['status'])
+            results.write(record)
+            with counts_lock:
+                counts[record['status']] += 1
+            mark = '✅' if record['status'] == 'succeeded' else '❌'
+            detail = record.get('note_url') or (record.get('error') or {}).get('error')
+            print(f"{mark} 第 {row_number} 行: {detail}", file=sys.stderr)
+
+    threads = [threading.Thread(target=worker, name=f'bulk-worker-{i}', daemon=True) for i in range(args.workers)]
+    for thread in threads:
+        thread.start()
+
+    started = time.time()
+    enqueued = 0
+    try:
+        for row_number, data in iter_rows(args.input):
+            if args.limit and enqueued >= args.limit:
+                break
+            if checkpoint.is_done(row_number, retry_failed=args.retry_failed):
+                counts['skipped'] += 1
+                continue
+            rows.put((row_number, data))
+            enqueued += 1
+    except KeyboardInterrupt:
+        print("\n⏹️ 收到中断信号，等待处理中的行结束（已完成的行都已写入检查点）...", file=sys.stderr)
+        stop_event.set()
+        while True:
+            try:
+                rows.get_nowait()
+            except queue.Empty:
+                break
+    finally:
+        for _ in threads:
+            rows.put(None)
+        for thread in threads:
+            thread.join()
+        checkpoint.close()
+        results.close()
+
+    print(f"\n📊 完成：成功 {counts['succeeded']}，失败 {counts['failed']}，"
+          f"跳过（已完成）{counts['skipped']}，耗时 {time.time() - started:.1f}秒", file=sys.stderr)
+    return 0 if counts['failed'] == 0 else 1
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="小红书批量发布工具（支持断点续传）")
+    parser.add_argument("input", help="输入文件（.jsonl 或 .csv）")
+    parser.add_argument("--cookie", default=os.environ.get('XHS_COOKIE'),
+                        help="默认账号 Cookie（行内未指定 cookie / account 时使用，也可用 XHS_COOKIE 环境变量）")
+    parser.add_argument("--accounts", default=os.environ.get('XHS_ACCOUNTS_FILE'),
+                        help="账号文件（JSON：{账号 ID: Cookie}），行内用 account 字段引用")
+    parser.add_argument("--workers", type=int, default=4, help="并发数（默认 4）")
+    parser.add_argument("--min-interval", type=float, default=30.0,
+                        help="同一账号两次发布的最小间隔秒数（默认 30）")
+    parser.add_argument("--state", help="检查点文件（默认 <input>.state）")
+    parser.add_argument("--results", help="结果文件（默认 <input>.results.jsonl）")
+    parser.add_argument("--retry-failed", action="store_true", help="重新发布上次失败的行")
+    parser.add_argument("--limit", type=int, help="本次最多处理的行数")
+    parser.add_argument("--verbose", action="store_true", help="输出发布流程的详细日志")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers 必须大于等于 1")
+    if args.min_interval < 0:
+        parser.error("--min-interval 不能为负数")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.verbose:
+        publish_app.logger.setLevel(logging.WARNING)
+    sys.exit(run_bulk(args))
@@ -2,11 +2,21 @@
 """
 签名服务器诊断工具
 用于排查签名生成问题
+
+压测模式（输出 JSON，用于评估签名服务器容量、对比版本）：
+    python diagnose_sign_server.py --bench https://your-server.onrender.com \
+        --concurrency 8 --duration 60 --mix permit=3,note=1 --output bench.json
 """
 
+import argparse
+import itertools
 import requests
 import json
+import math
+import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 def print_header(msg):
     print(f"\n{'='*70}")
@@ -203,7 +213,232 @@ def diagnose_sign_server(server_url):
    提供 Render 日志和完整错误信息
 """)
 
+
+# ========== 压测模式 ==========
+
+# 与发布流程一致的签名请求：获取上传凭证（GET，参数拼在 uri 中）和发布笔记（POST，带 data）
+PERMIT_URI = "/api/media/v1/upload/web/permit?biz_name=spectrum&scene=image&file_count=1&version=1&source=web"
+NOTE_URI = "/web_api/sns/v2/note"
+
+
+def build_bench_payload(kind, seq):
+    """构造压测用的签名请求体，seq 保证每次请求的 data 不同（与真实发布一致，不命中缓存）"""
+    payload = {
+        "a1": "bench_a1",
+        "web_session": "bench_session",
+        "web_id": "bench_web_id"
+    }
+    if kind == "permit":
+        payload.update(uri=PERMIT_URI, data=None)
+    else:
+        payload.update(uri=NOTE_URI, data={
+            "common": {
+                "type": "normal",
+                "title": f"压测笔记 {seq}",
+                "note_id": "",
+                "desc": f"签名服务器压测内容 #{seq}",
+                "source": '{"type":"web","ids":"","extraInfo":"{\\"subType\\":\\"official\\"}"}',
+                "business_binds": '{"version":1,"noteId":0,"noteOrderBind":{},"notePostTiming":{"postTime":null},"noteCollectionBind":{"id":""}}',
+                "ats": [],
+                "hash_tag": [],
+                "post_loc": {},
+                "privacy_info": {"op_type": 1, "type": 0},
+            },
+            "image_info": {"images": [{
+                "file_id": f"spectrum/bench_{seq}",
+                "metadata": {"source": -1},
+                "stickers": {"version": 2, "floating": []},
+                "extra_info_json": '{"mimeType":"image/jpeg"}',
+            }]},
+            "video_info": None,
+        })
+    return payload
+
+
+def parse_mix(mix):
+    """解析请求配比，如 "permit=3,note=1"，返回按权重展开的类型列表"""
+    kinds = []
+    for item in mix.split(','):
+        name, _, weight = item.strip().partition('=')
+        if name not in ("permit", "note"):
+            raise ValueError(f"未知的请求类型: {name}（可选 permit、note）")
+        kinds.extend([name] * int(weight or 1))
+    if not kinds:
+        raise ValueError("请求配比不能为空")
+    return kinds
+
+
+def percentile(sorted_values, pct):
+    """最近秩法计算百分位数"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(samples, elapsed):
+    """汇总一组样本：吞吐、延迟分位数（毫秒）和错误分布"""
+    ok_latencies = sorted(s["latency_ms"] for s in samples if s["ok"])
+    errors = {}
+    for s in samples:
+        if not s["ok"]:
+            errors[s["error"]] = errors.get(s["error"], 0) + 1
+    total = len(samples)
+    return {
+        "requests": total,
+        "succeeded": len(ok_latencies),
+        "failed": total - len(ok_latencies),
+        "error_rate": round((total - len(ok_latencies)) / total, 4) if total else 0.0,
+        "throughput_rps": round(len(ok_latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "min": ok_latencies[0] if ok_latencies else None,
+            "p50": percentile(ok_latencies, 50),
+            "p95": percentile(ok_latencies, 95),
+            "p99": percentile(ok_latencies, 99),
+            "max": ok_latencies[-1] if ok_latencies else None,
+            "mean": round(sum(ok_latencies) / len(ok_latencies), 2) if ok_latencies else None,
+        },
+        "errors": errors,
+    }
+
+
+def run_benchmark(server_url, concurrency=4, duration=30.0, total_requests=None,
+                  mix="permit=3,note=1", warmup=5.0, timeout=30.0):
+    """
+    并发压测签名服务器 /sign 接口
+    
+    在 duration 秒内（或发送 total_requests 个请求后）停止，返回可直接序列化为 JSON 的结果。
+    前 warmup 秒的样本单独统计，用于观察冷启动/预热行为，不计入稳态指标。
+    """
+    server_url = server_url.rstrip('/')
+    kinds = parse_mix(mix)
+    counter = itertools.count()
+    samples = []
+    samples_lock = threading.Lock()
+    started_at = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    started = time.perf_counter()
+    deadline = None if total_requests else started + duration
+
+    def worker():
+        session = requests.Session()
+        while True:
+            seq = next(counter)
+            if total_requests is not None and seq >= total_requests:
+                return
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            kind = kinds[seq % len(kinds)]
+            payload = build_bench_payload(kind, seq)
+            sent_at = time.perf_counter()
+            error = None
+            try:
+                response = session.post(f"{server_url}/sign", json=payload, timeout=timeout)
+                if response.status_code != 200:
+                    error = f"http_{response.status_code}"
+                else:
+                    signs = response.json()
+                    if not signs.get('x-s') or not signs.get('x-t'):
+                        error = "incomplete_sign"
+            except requests.Timeout:
+                error = "timeout"
+            except Exception as e:
+                error = type(e).__name__
+            finished = time.perf_counter()
+            with samples_lock:
+                samples.append({
+                    "kind": kind,
+                    "offset_s": sent_at - started,
+                    "latency_ms": round((finished - sent_at) * 1000, 2),
+                    "ok": error is None,
+                    "error": error,
+                })
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    elapsed = time.perf_counter() - started
+
+    samples.sort(key=lambda s: s["offset_s"])
+    warmup_samples = [s for s in samples if s["offset_s"] < warmup]
+    steady_samples = [s for s in samples if s["offset_s"] >= warmup]
+    steady_elapsed = max(elapsed - warmup, 0)
+    # 请求数模式下可能在预热窗口内就结束，此时稳态指标退化为全量指标
+    if not steady_samples:
+        steady_samples, steady_elapsed = samples, elapsed
+
+    return {
+        "server_url": server_url,
+        "started_at": started_at,
+        "config": {
+            "concurrency": concurrency,
+            "duration_s": None if total_requests else duration,
+            "requests": total_requests,
+            "mix": mix,
+            "warmup_s": warmup,
+            "timeout_s": timeout,
+        },
+        "elapsed_s": round(elapsed, 3),
+        "overall": summarize(samples, elapsed),
+        "steady": summarize(steady_samples, steady_elapsed),
+        "warmup": {
+            "first_request_ms": samples[0]["latency_ms"] if samples else None,
+            **summarize(warmup_samples, min(warmup, elapsed)),
+        },
+        "by_kind": {
+            kind: summarize([s for s in steady_samples if s["kind"] == kind], steady_elapsed)
+            for kind in sorted(set(kinds))
+        },
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="签名服务器诊断 / 压测工具")
+    parser.add_argument("--bench", metavar="SERVER_URL", help="压测模式：签名服务器地址")
+    parser.add_argument("--concurrency", type=int, default=4, help="并发数（默认 4）")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--duration", type=float, default=30.0, help="压测时长（秒，默认 30）")
+    group.add_argument("--requests", type=int, help="请求总数（指定后忽略 --duration）")
+    parser.add_argument("--mix", default="permit=3,note=1",
+                        help="请求配比，可选 permit（上传凭证）、note（发布笔记），默认 permit=3,note=1")
+    parser.add_argument("--warmup", type=float, default=5.0, help="预热窗口（秒，默认 5），单独统计")
+    parser.add_argument("--timeout", type=float, default=30.0, help="单次请求超时（秒，默认 30）")
+    parser.add_argument("--output", help="结果 JSON 写入文件（默认输出到 stdout）")
+    return parser.parse_args(argv)
+
+
+def main_bench(args):
+    print(f"🚀 压测 {args.bench}：并发 {args.concurrency}，"
+          f"{f'{args.requests} 个请求' if args.requests else f'{args.duration} 秒'}，配比 {args.mix}",
+          file=sys.stderr)
+    result = run_benchmark(
+        args.bench,
+        concurrency=args.concurrency,
+        duration=args.duration,
+        total_requests=args.requests,
+        mix=args.mix,
+        warmup=args.warmup,
+        timeout=args.timeout,
+    )
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+        steady = result["steady"]
+        print(f"✅ 完成：{steady['throughput_rps']} req/s，p95 {steady['latency_ms']['p95']} ms，"
+              f"错误率 {steady['error_rate']}，结果已写入 {args.output}", file=sys.stderr)
+    else:
+        print(output)
+    return 0 if result["overall"]["succeeded"] else 1
+
 if __name__ == "__main__":
+    args = parse_args()
+    if args.bench:
+        try:
+            sys.exit(main_bench(args))
+        except ValueError as e:
+            print(f"❌ 参数错误: {e}", file=sys.stderr)
+            sys.exit(2)
+
     print("🚀 签名服务器诊断工具\n")
     
     server_url = input("请输入签名服务器地址 (例如: https://your-server.onrender.com): ").strip()